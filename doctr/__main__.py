@@ -40,7 +40,15 @@ GitHub_login, guess_github_repo, AuthenticationFailed, GitHubError,
     get_travis_token)
 from .travis import (setup_GitHub_push, commit_docs, push_docs,
     get_current_repo, sync_from_log, find_sphinx_build_dir, run,
-    get_travis_branch, copy_to_tmp, checkout_deploy_branch)
+    get_travis_branch, copy_to_tmp, checkout_deploy_branch, is_glob,
+    COPY_MODES, ProgressPrinter, plan_deploy, format_plan,
+    commit_docs_plumbing, checkout_deploy_worktree, remove_deploy_worktree,
+    configure_git_for_large_repos, get_sparse_dir, save_prefetch_state,
+    load_prefetch_state, write_gitattributes, get_binary_patterns,
+    fetch_deploy_branches, get_deploy_metadata, find_deploy_dirs, plan_gc,
+    commit_gc, get_remote_branches, analyze_deploy, format_deploy_stats,
+    check_deploy_budgets, is_deploy_job, get_travis_job_number,
+    DOCTR_WORKING_BRANCH)
 
 from .common import (red, green, blue, bold_black, bold_magenta, BOLD_BLACK,
                      BOLD_MAGENTA, RESET, input)
@@ -97,6 +105,79 @@ def make_parser_with_config_adder(parser, config):
     return internal
 
 
+def add_push_setup_arguments(parser, parser_add_argument):
+    """
+    Add the options used to set up the push to GitHub, which are shared by
+    'doctr deploy', 'doctr prefetch' and 'doctr gc'.
+    """
+    parser_add_argument('--deploy-job', type=int, default=None, metavar='N',
+        help="""Only run in job N of the Travis build matrix (the number
+        after the dot in $TRAVIS_JOB_NUMBER, starting at 1). The other jobs
+        exit right away, without any network or git operations, so that only
+        one job fetches, commits and pushes. The default is to run in every
+        job.""")
+    parser_add_argument('--token', action='store_true', default=False,
+        help="""Push to GitHub using a personal access token. Use this if you
+        used 'doctr configure --token'.""")
+    parser_add_argument('--key-path', default=None,
+        help="""Path of the encrypted GitHub deploy key. The default is github_deploy_key_+
+        deploy respository name + .enc.""")
+    parser.add_argument('--deploy-branch-name', default=None,
+                        help="""Name of the branch to deploy to (default: 'master' for ``*.github.io``
+                        and wiki repos, 'gh-pages' otherwise)""")
+    parser_add_argument('--deploy-repo', default=None, help="""Repo to
+        deploy the docs to. By default, it deploys to the repo Doctr is run from.""")
+    parser_add_argument('--branch-whitelist', default=None, nargs='*',
+        help="""Branches to deploy from. Pass no arguments to not build on any branch
+        (typically used in conjunction with --build-tags). Note that you can
+        deploy from every branch with --no-require-master.""", metavar="BRANCH")
+    parser_add_argument('--no-require-master', dest='require_master', action='store_false',
+        default=True, help="""Allow docs to be pushed from a branch other than master""")
+    parser_add_argument('--build-tags', action='store_true',
+        default=False, help="""Deploy on tag builds. On a tag build,
+        $TRAVIS_TAG is set to the name of the tag. The default is to not
+        deploy on tag builds. Note that this will still build on a branch,
+        unless --branch-whitelist (with no arguments) is passed.""")
+    parser_add_argument('--cache-dir', default=None, help="""Directory
+        to keep a mirror of the deploy branch in, like $HOME/.cache/doctr. If
+        the directory is kept between builds (for instance with Travis'
+        cache), each build only fetches the commits that were pushed since the
+        last one, and the files of the deploy branch are read from the mirror.
+        A corrupt mirror is detected and created again. The default is to
+        fetch from scratch.""")
+    parser_add_argument('--keep-history', type=int, default=None,
+        metavar='N', help="""Only keep the last N commits on the deploy
+        branch (1 keeps a single commit with no history), so that clones and
+        fetches of the deploy repo don't get slower as more docs are
+        deployed. The branch is pushed with --force-with-lease, so pushes from
+        other builds are still detected. See also --archive-ref. The default
+        is to keep the whole history.""")
+    parser_add_argument('--archive-ref', default=None, help="""With
+        --keep-history, keep the old states of the deploy branch in this ref of
+        the deploy repo, like refs/doctr/gh-pages-archive. Each push adds the
+        state of the deploy branch before it to the archive. Refs outside of
+        refs/heads/ and refs/tags/ are not fetched by a plain 'git clone'.""")
+    parser_add_argument('--skip-if-cannot-push', action='store_true',
+        default=False, help="""Exit as soon as it is known that the build
+        cannot push (for instance on pull requests, forks and branches that
+        are not whitelisted), without fetching the deploy branch or syncing
+        and committing the docs. This is ignored by 'doctr deploy' when
+        --command or --plan is used. The default is to do everything except
+        the push, which checks that the deploy works.""")
+
+def parse_size(size):
+    """
+    Parse a size in bytes like ``'1000'``, ``'100K'``, ``'50M'`` or ``'2G'``
+    (powers of 1024) for argparse.
+    """
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3}
+    try:
+        if size[-1:].upper() in units:
+            return int(float(size[:-1]) * units[size[-1].upper()])
+        return int(size)
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid size: %r" % size)
+
 def get_parser(config=None):
     """
     return a parser suitable to parse CL arguments.
@@ -129,6 +210,12 @@ options available.
 
     subcommand = parser.add_subparsers(title='subcommand', dest='subcommand')
 
+    # The options shared with 'doctr prefetch' and 'doctr gc' can be set in
+    # .travis.yml too. make_parser_with_config_adder() removes the keys it
+    # uses, so they get their own copies.
+    prefetch_config = dict(config)
+    gc_config = dict(config)
+
     deploy_parser = subcommand.add_parser('deploy', help="""Deploy the docs to GitHub from Travis.""")
     deploy_parser.set_defaults(func=deploy)
     deploy_parser_add_argument = make_parser_with_config_adder(deploy_parser, config)
@@ -136,29 +223,13 @@ options available.
     if we do not appear to be on Travis.""")
     deploy_parser_add_argument('deploy_directory', type=str, nargs='?',
         help="""Directory to deploy the html documentation to on gh-pages.""")
-    deploy_parser_add_argument('--token', action='store_true', default=False,
-        help="""Push to GitHub using a personal access token. Use this if you
-        used 'doctr configure --token'.""")
-    deploy_parser_add_argument('--key-path', default=None,
-        help="""Path of the encrypted GitHub deploy key. The default is github_deploy_key_+
-        deploy respository name + .enc.""")
+    add_push_setup_arguments(deploy_parser, deploy_parser_add_argument)
     deploy_parser_add_argument('--built-docs', default=None,
         help="""Location of the built html documentation to be deployed to gh-pages. If not
         specified, Doctr will try to automatically detect build location
         (right now only works for Sphinx docs).""")
-    deploy_parser.add_argument('--deploy-branch-name', default=None,
-                               help="""Name of the branch to deploy to (default: 'master' for ``*.github.io``
-                               and wiki repos, 'gh-pages' otherwise)""")
     deploy_parser_add_argument('--tmp-dir', default=None,
         help=argparse.SUPPRESS)
-    deploy_parser_add_argument('--deploy-repo', default=None, help="""Repo to
-        deploy the docs to. By default, it deploys to the repo Doctr is run from.""")
-    deploy_parser_add_argument('--branch-whitelist', default=None, nargs='*',
-        help="""Branches to deploy from. Pass no arguments to not build on any branch
-        (typically used in conjunction with --build-tags). Note that you can
-        deploy from every branch with --no-require-master.""", metavar="BRANCH")
-    deploy_parser_add_argument('--no-require-master', dest='require_master', action='store_false',
-        default=True, help="""Allow docs to be pushed from a branch other than master""")
     deploy_parser_add_argument('--command', default=None,
         help="""Command to be run before committing and pushing. This command
         will be run from the deploy repository/branch. If the command creates
@@ -175,22 +246,143 @@ options available.
     deploy_parser_add_argument('--no-push', dest='push', action='store_false',
         default=True, help="Run all the steps except the last push step. "
         "Useful for debugging")
-    deploy_parser_add_argument('--build-tags', action='store_true',
-        default=False, help="""Deploy on tag builds. On a tag build,
-        $TRAVIS_TAG is set to the name of the tag. The default is to not
-        deploy on tag builds. Note that this will still build on a branch,
-        unless --branch-whitelist (with no arguments) is passed.""")
     deploy_parser_add_argument('--gh-pages-docs', default=None,
         help="""!!DEPRECATED!! Directory to deploy the html documentation to on gh-pages.
         The default is %(default)r. The deploy directory should be passed as
         the first argument to 'doctr deploy'. This flag is kept for backwards
         compatibility.""")
     deploy_parser_add_argument('--exclude', nargs='+', default=(), help="""Files and
-        directories from --built-docs that are not copied.""")
+        directories from --built-docs that are not copied. Patterns containing
+        glob characters (like '*.ipynb' or '_sources/**/*.txt') are matched
+        gitignore-style relative to --built-docs.""")
+    deploy_parser_add_argument('--skip-unchanged', action='store_true',
+        default=False, help="""Only copy and commit files whose contents differ
+        from the ones already on the deploy branch (compared by their git blob
+        hash). The default is to copy every file.""")
+    deploy_parser_add_argument('--jobs', type=int, default=1, help="""Number
+        of files to copy or remove at once when syncing. This mostly helps on
+        disks where the latency of each file operation dominates. The default
+        is %(default)s.""")
+    deploy_parser_add_argument('--copy-mode', default='copy', choices=COPY_MODES,
+        help="""How to transfer the built docs into the deploy branch. 'reflink'
+        makes copy-on-write clones (btrfs and xfs), 'hardlink' hard links the
+        files when possible, and 'auto' tries a reflink, an in-kernel copy
+        (copy_file_range), and then a hard link. Unsupported strategies fall
+        back to a plain copy. The default, 'copy', copies the files and their
+        metadata.""")
+    deploy_parser_add_argument('--engine', default='checkout',
+        choices=['checkout', 'worktree', 'plumbing'], help="""How to build the deploy
+        commit. 'checkout' stashes the current checkout, checks out the deploy
+        branch, copies the built docs over it and commits. 'worktree' does the
+        same in a separate git worktree, so the current checkout (including
+        ignored files) is never stashed or touched. --command is run in the
+        worktree. 'plumbing' never
+        checks out the deploy branch: it hashes the built docs into a
+        temporary index based on the remote deploy branch and creates the
+        commit with git plumbing commands, so disk writes scale with the built
+        docs rather than with everything on the deploy branch. 'plumbing'
+        cannot be used with --command or --no-sync. The default is
+        %(default)r.""")
+    deploy_parser_add_argument('--sparse-checkout', action='store_true',
+        default=False, help="""Only check out the deploy directory (and the
+        files at the top level of the deploy branch, like .nojekyll) instead of
+        the whole deploy branch, using a cone mode sparse checkout. Everything
+        outside of it is left untouched in the commit. This helps when the
+        deploy branch has docs for many versions in separate directories.
+        Requires git 2.27 or newer.""")
+    deploy_parser_add_argument('--plan', nargs='?', const='summary', default=None,
+        choices=['summary', 'json'], help="""Print what the deploy would add,
+        modify and remove (and how many bytes) and exit, without stashing,
+        checking out, copying or committing anything. The plan is computed
+        from the built docs, the .doctr-files manifest and the tree of the
+        remote deploy branch. Pass 'json' to print it as JSON.""")
+    deploy_parser_add_argument('--progress-interval', type=float, default=10,
+        help="""Print a progress line with the throughput every this many
+        seconds while syncing and committing the docs. Use 0 to only print a
+        summary at the end of each step. The default is %(default)s.""")
+    deploy_parser_add_argument('--also-deploy', nargs=3, action='append',
+        default=[], metavar=('BRANCH', 'BUILT_DOCS', 'DEPLOY_DIR'),
+        help="""Also deploy the files in BUILT_DOCS to DEPLOY_DIR on the
+        branch BRANCH of the deploy repo (for instance a machine readable
+        index of the versions on a separate branch). The commit is made
+        without checking out BRANCH, like with --engine plumbing. All the
+        branches are pushed together with a single 'git push --atomic', so
+        either all of them are updated or none of them is. Can be given
+        several times. Cannot be used with --max-push-size.""")
+    deploy_parser_add_argument('--no-gitattributes', dest='gitattributes',
+        action='store_false', default=True, help="""Don't maintain a
+        .gitattributes file at the root of the deploy branch. By default,
+        already compressed file types in the built docs (like .png, .woff2 and
+        .zip) are marked -delta in a block of it, so that git doesn't spend
+        time trying to delta compress them when pushing.""")
+    deploy_parser_add_argument('--max-push-size', type=parse_size, default=None,
+        help="""Split the deploy into several commits, each adding at most
+        this many bytes of files (like 500M), and push them one at a time.
+        This helps with large first deploys or full rebuilds that hit GitHub's
+        push size limits or time out. If a push fails, the commits that
+        already made it are not pushed again. The default is to push a single
+        commit.""")
+    deploy_parser_add_argument('--max-deploy-size', type=parse_size,
+        default=None, help="""Fail the deploy, before pushing, if the files
+        deployed to the deploy directory (as listed in its .doctr-files) add
+        up to more than this many bytes (like 200M).""")
+    deploy_parser_add_argument('--max-growth', type=parse_size, default=None,
+        help="""Fail the deploy, before pushing, if the files deployed to the
+        deploy directory grew by more than this many bytes (like 20M) since
+        the previous deploy.""")
+    deploy_parser_add_argument('--stats-file', default=None, help="""Write
+        the statistics of the deploy (the number and total size of the
+        deployed files, how much they grew since the previous deploy, the
+        largest files, and the number and size of the files by extension) to
+        this file as JSON. The statistics are computed and printed when this,
+        --max-deploy-size or --max-growth is given.""")
 
     if config:
         print('Warning, The following options in `.travis.yml` were not recognized:\n%s' % json.dumps(config, indent=2))
 
+    prefetch_parser = subcommand.add_parser('prefetch', help="""Set up the
+        push to GitHub and fetch the deploy branch ahead of 'doctr deploy'.""",
+        description="""Do the setup of 'doctr deploy' (checking if the build is
+        a fork, decrypting the deploy key and fetching the deploy branch) ahead
+        of time, so that it can run in the background while the docs build.
+        'doctr deploy' with the same deploy repository, branch and --token
+        option reuses the setup instead of doing it again. Wait for 'doctr
+        prefetch' to finish before running 'doctr deploy'.""")
+    prefetch_parser.set_defaults(func=prefetch)
+    prefetch_parser.add_argument('--force', action='store_true', help="""Run the
+    prefetch command even if we do not appear to be on Travis.""")
+    add_push_setup_arguments(prefetch_parser,
+        make_parser_with_config_adder(prefetch_parser, prefetch_config))
+
+    gc_parser = subcommand.add_parser('gc', help="""Remove old deploy
+        directories from the deploy branch.""",
+        description="""Remove the deploy directories (like docs-$TRAVIS_BRANCH
+        or tag-$TRAVIS_TAG) that match the given retention rules from the
+        deploy branch, in a single commit. Deploy directories are found by
+        their .doctr-files, which record the branch or tag and the time of
+        the last deploy that changed them (deploys that don't change any file
+        leave the .doctr-files as it is). Directories deployed by older
+        versions of doctr, which do not record these, are never removed. The
+        root of the deploy branch is never removed.""")
+    gc_parser.set_defaults(func=gc)
+    gc_parser.add_argument('--force', action='store_true', help="""Run the
+    gc command even if we do not appear to be on Travis.""")
+    gc_parser.add_argument('--keep-tags', type=int, default=None, metavar='N',
+        help="""Only keep the directories of the N most recently deployed
+        tags. All the directories of a tag (like tag-v1.0 and a stable
+        directory deployed on the same tag build) count as one.""")
+    gc_parser.add_argument('--remove-deleted-branches', action='store_true',
+        default=False, help="""Remove the directories of branches that no
+        longer exist in the repository being built.""")
+    gc_parser.add_argument('--max-age', type=float, default=None,
+        metavar='DAYS', help="""Remove the directories whose contents have
+        been unchanged for more than DAYS days. A directory that is redeployed
+        with the same contents counts as unchanged.""")
+    gc_parser.add_argument('--dry-run', action='store_true', default=False,
+        help="""Only print the directories that would be removed.""")
+    add_push_setup_arguments(gc_parser,
+        make_parser_with_config_adder(gc_parser, gc_config))
+
     configure_parser = subcommand.add_parser('configure', help="Configure doctr. This command should be run locally (not on Travis).")
     configure_parser.set_defaults(func=configure)
     configure_parser.add_argument('--force', action='store_true', help="""Run the configure command even
@@ -268,6 +460,171 @@ def process_args(parser):
 def on_travis():
     return os.environ.get("TRAVIS_JOB_NUMBER", '')
 
+def check_deploy_job(args, parser):
+    """
+    Return whether the current job is the one that deploys (see
+    --deploy-job), printing a message if it isn't.
+    """
+    if args.deploy_job is not None and args.deploy_job < 1:
+        parser.error("--deploy-job must be at least 1")
+    if is_deploy_job(args.deploy_job):
+        return True
+    print("This is job %s of the build, and only job %s deploys. Not doing "
+          "anything else." % (get_travis_job_number(), args.deploy_job))
+    return False
+
+def get_deploy_target(args):
+    """
+    Return the repository and the branch to deploy to.
+    """
+    build_repo = get_current_repo()
+    deploy_repo = args.deploy_repo or build_repo
+
+    if args.deploy_branch_name:
+        deploy_branch = args.deploy_branch_name
+    else:
+        deploy_branch = 'master' if deploy_repo.endswith(('.github.io', '.github.com', '.wiki')) else 'gh-pages'
+
+    return deploy_repo, deploy_branch
+
+def get_auth_type(args):
+    return 'token' if args.token else 'deploy_key'
+
+def setup_push(args, deploy_repo, deploy_branch, skip_if_cannot_push=False,
+    filter_blobs=True):
+    """
+    Run :func:`setup_GitHub_push` with the options in ``args``, and return
+    whether the build can push.
+    """
+    config = get_config()
+
+    _, env_name, keypath = get_deploy_key_repo(deploy_repo, args.key_path, key_ext='.enc')
+
+    branch_whitelist = set() if args.require_master else set(get_travis_branch())
+    branch_whitelist.update(set(config.get('branches', set())))
+    if args.branch_whitelist is not None:
+        branch_whitelist.update(set(args.branch_whitelist))
+    elif not branch_whitelist:
+        branch_whitelist = {'master'}
+
+    return setup_GitHub_push(deploy_repo, deploy_branch=deploy_branch,
+                             auth_type=get_auth_type(args),
+                             full_key_path=keypath,
+                             branch_whitelist=branch_whitelist,
+                             build_tags=args.build_tags,
+                             env_name=env_name,
+                             cache_dir=args.cache_dir,
+                             skip_if_cannot_push=skip_if_cannot_push,
+                             depth=args.keep_history or 1,
+                             filter_blobs=filter_blobs)
+
+def prefetch(args, parser):
+    print("Running doctr prefetch, version", __version__)
+
+    if not args.force and not on_travis():
+        parser.error("doctr does not appear to be running on Travis. Use "
+                     "doctr prefetch --force to run anyway.")
+
+    if not check_deploy_job(args, parser):
+        return
+
+    deploy_repo, deploy_branch = get_deploy_target(args)
+    configure_git_for_large_repos()
+    # Download the file contents now, while the docs build, rather than one by
+    # one when the deploy checks out the branch.
+    canpush = setup_push(args, deploy_repo, deploy_branch,
+        skip_if_cannot_push=args.skip_if_cannot_push, filter_blobs=False)
+    save_prefetch_state(deploy_repo, deploy_branch,
+        auth_type=get_auth_type(args), canpush=canpush)
+
+def get_parent(commit):
+    """
+    Return the first parent of ``commit``, or None if it has no parents.
+    """
+    parents = subprocess.check_output(['git', 'rev-list', '--parents', '-n',
+        '1', commit]).decode('utf-8').split()[1:]
+    return parents[0] if parents else None
+
+def check_deploy_stats(args, deploys):
+    """
+    Print the statistics of the deploys, a list of ``(working branch, deploy
+    directory)``, write them to ``--stats-file``, and exit if they are over
+    ``--max-deploy-size`` or ``--max-growth``.
+    """
+    stats = []
+    errors = []
+    for working_branch, deploy_dir in deploys:
+        deploy_stats = analyze_deploy(working_branch, deploy_dir,
+            previous=get_parent(working_branch))
+        print(format_deploy_stats(deploy_stats))
+        stats.append(deploy_stats)
+        errors += check_deploy_budgets(deploy_stats,
+            max_deploy_size=args.max_deploy_size, max_growth=args.max_growth)
+
+    if args.stats_file:
+        with open(args.stats_file, 'w') as f:
+            json.dump(stats, f, indent=2)
+
+    if errors:
+        sys.exit(red('\n'.join(errors) + "\nNot pushing."))
+
+def gc(args, parser):
+    print("Running doctr gc, version", __version__)
+
+    if not args.force and not on_travis():
+        parser.error("doctr does not appear to be running on Travis. Use "
+                     "doctr gc --force to run anyway.")
+
+    if not check_deploy_job(args, parser):
+        return
+
+    if (args.keep_tags is None and not args.remove_deleted_branches and
+        args.max_age is None):
+        parser.error("No retention rules given. Use --keep-tags, "
+                     "--remove-deleted-branches or --max-age.")
+
+    if args.keep_tags is not None and args.keep_tags < 0:
+        parser.error("--keep-tags cannot be negative")
+
+    if args.keep_history is not None and args.keep_history < 1:
+        parser.error("--keep-history must be at least 1")
+    if args.archive_ref and args.keep_history is None:
+        parser.error("--archive-ref can only be used with --keep-history")
+
+    deploy_repo, deploy_branch = get_deploy_target(args)
+    canpush = load_prefetch_state(deploy_repo, deploy_branch,
+        auth_type=get_auth_type(args))
+    skip_if_cannot_push = args.skip_if_cannot_push and not args.dry_run
+    if canpush is None:
+        canpush = setup_push(args, deploy_repo, deploy_branch,
+            skip_if_cannot_push=skip_if_cannot_push)
+    if not canpush and skip_if_cannot_push:
+        print("Don't have permission to push. Not doing anything else.")
+        return
+
+    ref = 'doctr_remote/' + deploy_branch
+    deploy_dirs = find_deploy_dirs(ref)
+    existing_branches = (get_remote_branches('origin') if
+        args.remove_deleted_branches else None)
+    remove = plan_gc(deploy_dirs, keep_tags=args.keep_tags,
+        existing_branches=existing_branches, max_age=args.max_age)
+    print("Found %s deploy directories on %s" % (len(deploy_dirs), deploy_branch))
+    for d, reason in remove.items():
+        print("Removing %s: %s" % (d, reason))
+
+    if not remove:
+        print("There are no deploy directories to remove")
+        return
+    if args.dry_run:
+        return
+
+    print("Removed %s files" % commit_gc(ref, deploy_dirs, remove))
+    if canpush:
+        push_docs(deploy_branch, keep_history=args.keep_history,
+            archive_ref=args.archive_ref)
+    else:
+        print("Don't have permission to push. Not trying.")
+
 def deploy(args, parser):
     print("Running doctr deploy, version", __version__)
 
@@ -275,8 +632,6 @@ def deploy(args, parser):
         parser.error("doctr does not appear to be running on Travis. Use "
                      "doctr deploy <target-dir> --force to run anyway.")
 
-    config = get_config()
-
     if args.tmp_dir:
         parser.error("The --tmp-dir flag has been removed (doctr no longer uses a temporary directory when deploying).")
 
@@ -291,50 +646,160 @@ def deploy(args, parser):
 
     deploy_dir = args.gh_pages_docs or args.deploy_directory
 
-    build_repo = get_current_repo()
-    deploy_repo = args.deploy_repo or build_repo
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
 
-    if args.deploy_branch_name:
-        deploy_branch = args.deploy_branch_name
-    else:
-        deploy_branch = 'master' if deploy_repo.endswith(('.github.io', '.github.com', '.wiki')) else 'gh-pages'
+    if not check_deploy_job(args, parser):
+        return
 
-    _, env_name, keypath = get_deploy_key_repo(deploy_repo, args.key_path, key_ext='.enc')
+    deploy_repo, deploy_branch = get_deploy_target(args)
+
+    progress = ProgressPrinter(interval=args.progress_interval)
+    configure_git_for_large_repos()
+
+    if args.plan and not args.sync:
+        parser.error("--plan cannot be used with --no-sync")
+
+    if args.also_deploy and args.max_push_size:
+        parser.error("--also-deploy cannot be used with --max-push-size")
+
+    if args.keep_history is not None:
+        if args.keep_history < 1:
+            parser.error("--keep-history must be at least 1")
+        if args.also_deploy or args.max_push_size:
+            parser.error("--keep-history cannot be used with --also-deploy or --max-push-size")
+    elif args.archive_ref:
+        parser.error("--archive-ref can only be used with --keep-history")
+
+    if args.stats_file:
+        # The worktree engine changes the current directory
+        args.stats_file = os.path.abspath(args.stats_file)
+
+    if args.engine == 'plumbing' and (args.command or not args.sync):
+        parser.error("--engine plumbing cannot be used with --command or --no-sync")
 
     current_commit = subprocess.check_output(['git', 'rev-parse', 'HEAD']).decode('utf-8').strip()
+    build_dir = os.getcwd()
+    stashed = False
+    worktree = None
+    sparse_dir = None
     try:
-        branch_whitelist = set() if args.require_master else set(get_travis_branch())
-        branch_whitelist.update(set(config.get('branches', set())))
-        if args.branch_whitelist is not None:
-            branch_whitelist.update(set(args.branch_whitelist))
-        elif not branch_whitelist:
-            branch_whitelist = {'master'}
-
-        canpush = setup_GitHub_push(deploy_repo, deploy_branch=deploy_branch,
-                                     auth_type='token' if args.token else 'deploy_key',
-                                     full_key_path=keypath,
-                                     branch_whitelist=branch_whitelist,
-                                     build_tags=args.build_tags,
-                                     env_name=env_name)
+        canpush = load_prefetch_state(deploy_repo, deploy_branch,
+            auth_type=get_auth_type(args))
+        # --command and --plan are useful without pushing
+        skip_if_cannot_push = (args.skip_if_cannot_push and not args.command
+            and not args.plan)
+        if canpush is None:
+            canpush = setup_push(args, deploy_repo, deploy_branch,
+                skip_if_cannot_push=skip_if_cannot_push)
+        if not canpush and skip_if_cannot_push:
+            print("Don't have permission to push. Not doing anything else.")
+            return
 
         if args.sync:
             built_docs = args.built_docs or find_sphinx_build_dir()
-            exclude = [os.path.relpath(i, built_docs) for i in args.exclude]
-            if args.temp_dir:
+            # Glob patterns are relative to --built-docs. Plain paths are
+            # relative to the current directory.
+            exclude = [i if is_glob(i) else os.path.relpath(i, built_docs)
+                       for i in args.exclude]
+
+        if args.plan:
+            plan = plan_deploy(built_docs, deploy_dir,
+                'doctr_remote/' + deploy_branch, exclude=exclude, jobs=args.jobs)
+            if args.plan == 'json':
+                print(json.dumps(plan, indent=2))
+            else:
+                print(format_plan(plan))
+            return
+
+        # The other branches are committed first, since their built docs
+        # might not be there anymore after stashing.
+        metadata = get_deploy_metadata()
+        extra_branches = {}
+        extra_dirs = {}
+        if args.also_deploy:
+            fetch_deploy_branches([branch for branch, _, _ in args.also_deploy])
+            for branch, src, dir in args.also_deploy:
+                print("Committing", src, "to", dir, "on", branch)
+                working_branch = DOCTR_WORKING_BRANCH + '-' + branch
+                if commit_docs_plumbing(src, dir, branch,
+                    gitattributes=args.gitattributes, branch=working_branch,
+                    metadata=metadata, callback=progress):
+                    extra_branches[branch] = working_branch
+                    extra_dirs[branch] = dir
+                else:
+                    print("The docs on", branch, "have not changed")
+
+        def push(changes):
+            branches = dict(extra_branches)
+            if changes:
+                branches[deploy_branch] = DOCTR_WORKING_BRANCH
+            if branches:
+                if (args.stats_file or args.max_deploy_size is not None or
+                    args.max_growth is not None):
+                    check_deploy_stats(args, [(working_branch, deploy_dir if
+                        branch == deploy_branch else extra_dirs[branch]) for
+                        branch, working_branch in branches.items()])
+                if canpush and args.push:
+                    push_docs(deploy_branch, max_push_size=args.max_push_size,
+                        branches=branches, keep_history=args.keep_history,
+                        archive_ref=args.archive_ref)
+                else:
+                    print("Don't have permission to push. Not trying.")
+            else:
+                print("The docs have not changed. Not updating")
+
+        if args.engine == 'plumbing':
+            # The current checkout is never touched, so there is no need to
+            # stash or to copy the built docs to a temporary directory.
+            push(commit_docs_plumbing(built_docs, deploy_dir, deploy_branch,
+                exclude=exclude, gitattributes=args.gitattributes,
+                metadata=metadata, callback=progress))
+            return
+
+        if args.sparse_checkout:
+            sparse_dir = get_sparse_dir(deploy_dir)
+
+        if args.engine == 'worktree':
+            # The commands below run in the worktree, so the built docs need
+            # an absolute path. They are not copied anywhere, since the
+            # current checkout is never touched.
+            if args.sync:
+                built_docs = os.path.abspath(built_docs)
+            worktree = checkout_deploy_worktree(deploy_branch,
+                sparse_dir=sparse_dir)
+            os.chdir(worktree)
+        else:
+            if args.sync and args.temp_dir:
                 built_docs = copy_to_tmp(built_docs)
-            exclude = [os.path.normpath(os.path.join(built_docs, i)) for i in exclude]
 
-        # Reset in case there are modified files that are tracked in the
-        # deploy branch.
-        run(['git', 'stash', '--all'])
-        checkout_deploy_branch(deploy_branch, canpush=canpush)
+            # Reset in case there are modified files that are tracked in the
+            # deploy branch.
+            run(['git', 'stash', '--all'])
+            stashed = True
+            checkout_deploy_branch(deploy_branch, canpush=canpush,
+                sparse_dir=sparse_dir)
 
         if args.sync:
             log_file = os.path.join(deploy_dir, '.doctr-files')
 
             print("Moving built docs into place")
-            added, removed = sync_from_log(src=built_docs,
-                dst=deploy_dir, log_file=log_file, exclude=exclude)
+            result = sync_from_log(src=built_docs, dst=deploy_dir,
+                log_file=log_file, exclude=exclude,
+                skip_unchanged=args.skip_unchanged, jobs=args.jobs,
+                copy_mode=args.copy_mode, manifest_version=2,
+                metadata=metadata, callback=progress)
+            if args.skip_unchanged:
+                added, removed, unchanged = result
+                print("Skipped %d unchanged files" % len(unchanged))
+            else:
+                added, removed = result
+                unchanged = []
+
+            if args.gitattributes and write_gitattributes('.gitattributes',
+                get_binary_patterns(added + unchanged)):
+                print("Updated .gitattributes")
+                added.append('.gitattributes')
 
         else:
             added, removed = [], []
@@ -342,23 +807,22 @@ def deploy(args, parser):
         if args.command:
             run(args.command, shell=True)
 
-        changes = commit_docs(added=added, removed=removed)
-        if changes:
-            if canpush and args.push:
-                push_docs(deploy_branch)
-            else:
-                print("Don't have permission to push. Not trying.")
-        else:
-            print("The docs have not changed. Not updating")
+        push(commit_docs(added=added, removed=removed, callback=progress))
     except BaseException as e:
         DOCTR_COMMAND = ' '.join(map(shlex.quote, sys.argv))
         print(red("ERROR: The doctr command %r failed: %r" % (DOCTR_COMMAND, e)),
             file=sys.stderr)
         raise
     finally:
-        run(['git', 'checkout', current_commit])
-        # Ignore error, won't do anything if there was nothing to stash
-        run(['git', 'stash', 'pop'], exit=False)
+        if worktree:
+            os.chdir(build_dir)
+            remove_deploy_worktree(worktree)
+        if stashed:
+            run(['git', 'checkout', current_commit])
+            if sparse_dir:
+                run(['git', 'sparse-checkout', 'disable'])
+            # Ignore error, won't do anything if there was nothing to stash
+            run(['git', 'stash', 'pop'], exit=False)
 
 class IncrementingInt:
     def __init__(self, i=0):
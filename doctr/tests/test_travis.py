@@ -4,16 +4,86 @@ functions that can be tested outside of actually running them on Travis.
 """
 
 import tempfile
+import glob
 import os
+import shutil
+import subprocess
+import time
 from os.path import join
 
 import pytest
 
-from ..travis import sync_from_log, determine_push_rights, copy_to_tmp
+from ..travis import (sync_from_log, determine_push_rights, copy_to_tmp,
+    git_blob_hash, compile_exclude, walk_built_docs, make_copier, COPY_MODES,
+    read_manifest, ProgressPrinter, plan_deploy, commit_docs_plumbing,
+    DOCTR_WORKING_BRANCH, commit_docs, checkout_deploy_worktree,
+    remove_deploy_worktree, fetch_deploy_branch, push_docs, get_deploy_mirror,
+    save_prefetch_state, load_prefetch_state, setup_GitHub_push,
+    use_origin_for_fetch, replay_commit, split_commit, update_gitattributes,
+    get_binary_patterns, get_push_config, GITATTRIBUTES_BEGIN, GITATTRIBUTES_END,
+    fetch_deploy_branches, truncate_history, find_deploy_dirs, plan_gc,
+    commit_gc, analyze_deploy, format_deploy_stats, check_deploy_budgets,
+    get_travis_job_number, is_deploy_job)
+from .. import travis
+
+@pytest.fixture
+def git_identity(monkeypatch):
+    for var in ['GIT_AUTHOR_NAME', 'GIT_COMMITTER_NAME']:
+        monkeypatch.setenv(var, 'Doctr Tests')
+    for var in ['GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_EMAIL']:
+        monkeypatch.setenv(var, 'doctr@example.com')
+
+@pytest.fixture
+def deploy_repos(git_identity):
+    """
+    A build repository with an initial commit, and a bare deploy repository
+    that is set up as its doctr_remote. The current directory is the build
+    repository.
+    """
+    with tempfile.TemporaryDirectory() as dir:
+        old_curdir = os.path.abspath(os.curdir)
+        try:
+            git('init', '-q', '--bare', join(dir, 'deploy.git'))
+            git('-C', join(dir, 'deploy.git'), 'config', 'uploadpack.allowFilter', 'true')
+            git('init', '-q', join(dir, 'build'))
+            os.chdir(join(dir, 'build'))
+            with open('README', 'w') as f:
+                f.write('build repo')
+            git('add', 'README')
+            git('commit', '-q', '-m', 'Build repo')
+            git('remote', 'add', 'doctr_remote', join(dir, 'deploy.git'))
+            yield dir
+        finally:
+            os.chdir(old_curdir)
+
+def push_to_deploy_repo(dir, name, branch='gh-pages'):
+    """
+    Commit the file ``name`` to ``branch`` of the deploy repository from a
+    separate clone, as another build would.
+    """
+    other = join(dir, 'other')
+    if not os.path.exists(other):
+        git('clone', '-q', join(dir, 'deploy.git'), other)
+    if git('-C', other, 'ls-remote', 'origin', branch):
+        git('-C', other, 'fetch', '-q', 'origin', branch)
+        git('-C', other, 'checkout', '-q', '-B', branch, 'FETCH_HEAD')
+    else:
+        git('-C', other, 'checkout', '-q', '--orphan', branch)
+    os.makedirs(os.path.dirname(join(other, name)), exist_ok=True)
+    with open(join(other, name), 'w') as f:
+        f.write(name)
+    git('-C', other, 'add', name)
+    git('-C', other, 'commit', '-q', '-m', 'Add ' + name)
+    git('-C', other, 'push', '-q', 'origin', branch)
+
+def git(*args):
+    return subprocess.check_output(['git', '-c', 'user.name=Doctr Tests',
+        '-c', 'user.email=doctr@example.com', *args]).decode('utf-8').strip()
 
 @pytest.mark.parametrize("src", ["src"])
 @pytest.mark.parametrize("dst", ['.', 'dst'])
-def test_sync_from_log(src, dst):
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_sync_from_log(src, dst, jobs):
     with tempfile.TemporaryDirectory() as dir:
         try:
             old_curdir = os.path.abspath(os.curdir)
@@ -30,7 +100,7 @@ def test_sync_from_log(src, dst):
                 f.write('test2')
 
             # Test that the sync happens
-            added, removed = sync_from_log(src, dst, 'logfile')
+            added, removed = sync_from_log(src, dst, 'logfile', jobs=jobs)
 
             assert added == [
                 join(dst, 'test1'),
@@ -58,7 +128,7 @@ def test_sync_from_log(src, dst):
 
             # First test it is ignored when excluded
             added, removed = sync_from_log(src, dst, 'logfile',
-                exclude=['test3'])
+                exclude=['test3'], jobs=jobs)
 
             assert added == [
                 join(dst, 'test1'),
@@ -84,7 +154,7 @@ def test_sync_from_log(src, dst):
                     ])
 
             # Now test it it added normally
-            added, removed = sync_from_log(src, dst, 'logfile')
+            added, removed = sync_from_log(src, dst, 'logfile', jobs=jobs)
 
             assert added == [
                 join(dst, 'test1'),
@@ -115,7 +185,7 @@ def test_sync_from_log(src, dst):
             os.remove(join(src, 'test3'))
 
             # First test it is ignored with exclude
-            added, removed = sync_from_log(src, dst, 'logfile', exclude=['test3'])
+            added, removed = sync_from_log(src, dst, 'logfile', exclude=['test3'], jobs=jobs)
             assert added == [
                 join(dst, 'test1'),
                 join(dst, 'testdir', 'test2'),
@@ -144,7 +214,7 @@ def test_sync_from_log(src, dst):
             with open('logfile', 'a') as f:
                 f.write('\n' + join(dst, 'test3'))
 
-            added, removed = sync_from_log(src, dst, 'logfile')
+            added, removed = sync_from_log(src, dst, 'logfile', jobs=jobs)
 
             assert added == [
                 join(dst, 'test1'),
@@ -174,7 +244,7 @@ def test_sync_from_log(src, dst):
             with open(join(src, 'test1'), 'w') as f:
                 f.write('test1 modified')
 
-            added, removed = sync_from_log(src, dst, 'logfile')
+            added, removed = sync_from_log(src, dst, 'logfile', jobs=jobs)
 
             assert added == [
                 join(dst, 'test1'),
@@ -204,7 +274,7 @@ def test_sync_from_log(src, dst):
             with open(join(src, 'testdir2', 'test2'), 'w') as f:
                 f.write('test2')
 
-            added, removed = sync_from_log(src, dst, 'logfile', exclude=['testdir2'])
+            added, removed = sync_from_log(src, dst, 'logfile', exclude=['testdir2'], jobs=jobs)
 
 
             assert added == [
@@ -258,6 +328,1059 @@ def test_sync_from_log_file_to_dir(dst):
             os.chdir(old_curdir)
 
 
+def test_sync_from_log_skip_unchanged():
+    with tempfile.TemporaryDirectory() as dir:
+        try:
+            old_curdir = os.path.abspath(os.curdir)
+            os.chdir(dir)
+            git('init', '-q')
+
+            os.makedirs('src')
+            for name in ['test1', 'test2']:
+                with open(join('src', name), 'w') as f:
+                    f.write(name)
+
+            added, removed = sync_from_log('src', 'dst', 'logfile')
+            git('add', *added)
+            git('commit', '-q', '-m', 'Initial sync')
+
+            assert git_blob_hash(join('dst', 'test1')) == git('rev-parse', 'HEAD:dst/test1')
+
+            with open(join('src', 'test2'), 'w') as f:
+                f.write('test2 modified')
+
+            added, removed, unchanged = sync_from_log('src', 'dst', 'logfile',
+                skip_unchanged=True)
+
+            assert added == [join('dst', 'test2'), 'logfile']
+            assert removed == []
+            assert unchanged == [join('dst', 'test1')]
+
+            with open(join('dst', 'test2')) as f:
+                assert f.read() == 'test2 modified'
+
+            with open('logfile') as f:
+                assert f.read() == '\n'.join([
+                    join('dst', 'test1'),
+                    join('dst', 'test2'),
+                    ])
+        finally:
+            os.chdir(old_curdir)
+
+def test_sync_from_log_manifest_v2():
+    with tempfile.TemporaryDirectory() as dir:
+        try:
+            old_curdir = os.path.abspath(os.curdir)
+            os.chdir(dir)
+
+            os.makedirs('src')
+            for name in ['test1', 'test2', 'test3']:
+                with open(join('src', name), 'w') as f:
+                    f.write(name)
+
+            # A version 1 log file is upgraded
+            with open('logfile', 'w') as f:
+                f.write(join('dst', 'test3') + '\n' + join('dst', 'test4'))
+            os.makedirs('dst')
+            with open(join('dst', 'test4'), 'w') as f:
+                f.write('test4')
+
+            added, removed = sync_from_log('src', 'dst', 'logfile',
+                manifest_version=2)
+
+            assert removed == [join('dst', 'test4')]
+            assert not os.path.exists(join('dst', 'test4'))
+
+            with open('logfile') as f:
+                assert f.readline() == '# doctr-files v2\n'
+            assert read_manifest('logfile') == (2, [
+                (join('dst', name), 5, git_blob_hash(join('src', name)))
+                for name in ['test1', 'test2', 'test3']])
+
+            # Unchanged files are detected from the manifest, without git,
+            # and a version 2 log file is not downgraded.
+            os.remove(join('src', 'test3'))
+            with open(join('src', 'test2'), 'w') as f:
+                f.write('test2 modified')
+
+            added, removed, unchanged = sync_from_log('src', 'dst', 'logfile',
+                skip_unchanged=True)
+
+            assert added == [join('dst', 'test2'), 'logfile']
+            assert removed == [join('dst', 'test3')]
+            assert unchanged == [join('dst', 'test1')]
+
+            version, entries = read_manifest('logfile')
+            assert version == 2
+            assert [path for path, size, hash in entries] == [
+                join('dst', 'test1'), join('dst', 'test2')]
+
+            # Files that didn't change are not copied again, even without
+            # skip_unchanged.
+            with open(join('src', 'test2'), 'w') as f:
+                f.write('test2 modified again')
+            events = []
+            added, removed = sync_from_log('src', 'dst', 'logfile',
+                manifest_version=2, callback=lambda event, info:
+                events.append((event, info.get('path'))))
+            assert added == [join('dst', 'test1'), join('dst', 'test2'), 'logfile']
+            assert ('file_unchanged', join('dst', 'test1')) in events
+            assert ('file_copied', join('dst', 'test2')) in events
+            with open(join('dst', 'test2')) as f:
+                assert f.read() == 'test2 modified again'
+        finally:
+            os.chdir(old_curdir)
+
+@pytest.mark.parametrize("skip_unchanged", [False, True])
+def test_sync_from_log_manifest_stale(deploy_repos, skip_unchanged):
+    os.makedirs('html')
+    for name in ['a', 'b']:
+        with open(join('html', name), 'w') as f:
+            f.write(name*4)
+    log_file = join('docs', '.doctr-files')
+    sync_from_log('html', 'docs', log_file, manifest_version=2)
+    git('add', 'docs')
+    git('commit', '-q', '-m', 'Deploy')
+
+    # A --command (or another deploy, when a commit is replayed) changed a
+    # file without updating the manifest
+    with open(join('docs', 'a'), 'w') as f:
+        f.write('cccc')
+    git('add', join('docs', 'a'))
+    git('commit', '-q', '-m', 'Change a')
+
+    result = sync_from_log('html', 'docs', log_file, manifest_version=2,
+        skip_unchanged=skip_unchanged)
+    with open(join('docs', 'a')) as f:
+        assert f.read() == 'aaaa'
+    if skip_unchanged:
+        added, removed, unchanged = result
+        assert added == [join('docs', 'a'), log_file]
+        assert unchanged == [join('docs', 'b')]
+
+@pytest.mark.parametrize("jobs", [1, 4])
+def test_sync_from_log_callback(jobs):
+    with tempfile.TemporaryDirectory() as dir:
+        src, dst, log_file = join(dir, 'src'), join(dir, 'dst'), join(dir, 'logfile')
+        os.makedirs(src)
+        for name in ['test1', 'test2']:
+            with open(join(src, name), 'w') as f:
+                f.write(name)
+        sync_from_log(src, dst, log_file)
+        os.remove(join(src, 'test2'))
+
+        events = []
+        sync_from_log(src, dst, log_file, jobs=jobs,
+            callback=lambda event, info: events.append((event, info)))
+
+        assert events == [
+            ('phase_started', {'phase': 'remove'}),
+            ('file_removed', {'path': join(dst, 'test2'), 'bytes': 0, 'bytes_so_far': 0}),
+            ('phase_finished', {'phase': 'remove'}),
+            ('phase_started', {'phase': 'sync'}),
+            ('file_copied', {'path': join(dst, 'test1'), 'bytes': 5, 'bytes_so_far': 5}),
+            ('phase_finished', {'phase': 'sync'}),
+        ]
+
+def test_ProgressPrinter():
+    import io
+    out = io.StringIO()
+    progress = ProgressPrinter(interval=0, file=out)
+    progress('phase_started', {'phase': 'sync'})
+    for i in range(1, 4):
+        progress('file_copied', {'path': str(i), 'bytes': 10**6, 'bytes_so_far': i*10**6})
+    progress('phase_finished', {'phase': 'sync'})
+
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 1
+    assert lines[0].startswith("sync: 3 files (")
+    assert "3.0 MB (" in lines[0]
+
+    # A phase without file events only prints the time it took
+    progress('phase_started', {'phase': 'commit'})
+    progress('phase_finished', {'phase': 'commit'})
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[1].startswith("commit: ")
+    assert "files" not in lines[1]
+
+def test_plan_deploy():
+    with tempfile.TemporaryDirectory() as dir:
+        try:
+            old_curdir = os.path.abspath(os.curdir)
+            os.chdir(dir)
+            git('init', '-q')
+
+            os.makedirs('src')
+            for name in ['test1', 'test2', 'test3']:
+                with open(join('src', name), 'w') as f:
+                    f.write(name)
+            added, removed = sync_from_log('src', 'docs', join('docs', '.doctr-files'),
+                manifest_version=2)
+            # A file in the deploy directory that doctr didn't put there
+            with open(join('docs', 'other'), 'w') as f:
+                f.write('other')
+            git('add', 'docs')
+            git('commit', '-q', '-m', 'Deploy')
+            head = git('rev-parse', 'HEAD')
+
+            os.remove(join('src', 'test3'))
+            with open(join('src', 'test2'), 'w') as f:
+                f.write('test2 modified')
+            with open(join('src', 'test4'), 'w') as f:
+                f.write('test4')
+
+            plan = plan_deploy('src', 'docs', 'HEAD')
+            assert plan == {
+                'ref': 'HEAD',
+                'deploy_directory': 'docs',
+                'added': [join('docs', 'test4')],
+                'modified': [join('docs', 'test2')],
+                'removed': [join('docs', 'test3')],
+                'unchanged': 1,
+                'bytes': {'added': 5, 'modified': 14, 'removed': 5},
+            }
+
+            # Nothing was touched
+            assert git('rev-parse', 'HEAD') == head
+            assert git('status', '--porcelain', 'docs') == ''
+
+            assert plan_deploy('src', 'docs', 'doctr_remote/gh-pages')['added'] == [
+                join('docs', name) for name in ['test1', 'test2', 'test4']]
+        finally:
+            os.chdir(old_curdir)
+
+def test_commit_docs(git_identity, capsys):
+    with tempfile.TemporaryDirectory() as dir:
+        try:
+            old_curdir = os.path.abspath(os.curdir)
+            os.chdir(dir)
+            git('init', '-q')
+
+            os.makedirs('src')
+            for i in range(100):
+                with open(join('src', 'test-%s' % i), 'w') as f:
+                    f.write(str(i))
+            added, removed = sync_from_log('src', '.', '.doctr-files')
+            git('commit', '-q', '--allow-empty', '-m', 'Initial commit')
+
+            assert commit_docs(added=added, removed=removed)
+            assert len(git('ls-files').split()) == 101
+            assert "git update-index --add --remove -z --stdin (101 paths)" in capsys.readouterr().out
+
+            os.remove(join('src', 'test-0'))
+            added, removed = sync_from_log('src', '.', '.doctr-files')
+            assert commit_docs(added=added, removed=removed)
+            assert 'test-0' not in git('ls-files').split()
+            assert git('status', '--porcelain', '--untracked-files=no') == ''
+
+            assert not commit_docs(added=[], removed=[])
+        finally:
+            os.chdir(old_curdir)
+
+def test_commit_docs_large_branch(git_identity):
+    # A synthetic deploy branch with 200,000 files. Only the index is
+    # populated (the files are never written to disk), which also checks
+    # that commit_docs doesn't look at the working tree.
+    N = 200000
+    with tempfile.TemporaryDirectory() as dir:
+        try:
+            old_curdir = os.path.abspath(os.curdir)
+            os.chdir(dir)
+            git('init', '-q')
+            blob = subprocess.run(['git', 'hash-object', '-w', '--stdin'],
+                input=b'old docs', stdout=subprocess.PIPE).stdout.decode('utf-8').strip()
+            index_info = ''.join('100644 %s\tdocs-%s/page-%s.html\n' %
+                (blob, i//1000, i) for i in range(N))
+            subprocess.run(['git', 'update-index', '--index-info'],
+                input=index_info.encode('utf-8'), check=True)
+            git('commit', '-q', '-m', 'Large deploy branch')
+
+            os.makedirs('src')
+            with open(join('src', 'index.html'), 'w') as f:
+                f.write('new docs')
+            added, removed = sync_from_log('src', 'new-docs',
+                join('new-docs', '.doctr-files'))
+
+            t = time.perf_counter()
+            assert commit_docs(added=added, removed=removed)
+            elapsed = time.perf_counter() - t
+
+            assert git('rev-list', '--count', 'HEAD') == '2'
+            assert git('diff-tree', '-r', '--name-only', '--no-commit-id', 'HEAD').split() == [
+                'new-docs/.doctr-files', 'new-docs/index.html']
+            assert len(git('ls-tree', '-r', '--name-only', 'HEAD').split('\n')) == N + 2
+            # Generous, so that this isn't flaky on slow machines. Rewriting
+            # or stat-ing the 200,000 files would take much longer.
+            assert elapsed < 10, elapsed
+        finally:
+            os.chdir(old_curdir)
+
+def test_commit_docs_plumbing(git_identity):
+    with tempfile.TemporaryDirectory() as dir:
+        try:
+            old_curdir = os.path.abspath(os.curdir)
+            os.chdir(dir)
+            git('init', '-q')
+            git('commit', '-q', '--allow-empty', '-m', 'Build branch')
+            build_head = git('rev-parse', 'HEAD')
+
+            os.makedirs('src')
+            for name in ['test1', 'test2']:
+                with open(join('src', name), 'w') as f:
+                    f.write(name)
+
+            # The deploy branch doesn't exist yet
+            assert commit_docs_plumbing('src', 'docs', 'gh-pages')
+            first = git('rev-parse', DOCTR_WORKING_BRANCH)
+            assert git('ls-tree', '-r', '--name-only', first).split() == [
+                '.nojekyll', 'docs/.doctr-files', 'docs/test1', 'docs/test2']
+            assert git('show', first + ':docs/test2') == 'test2'
+            git('branch', 'gh-pages', first)
+
+            os.remove(join('src', 'test2'))
+            with open(join('src', 'test1'), 'w') as f:
+                f.write('test1 modified')
+
+            assert commit_docs_plumbing('src', 'docs', 'gh-pages', parent='gh-pages')
+            second = git('rev-parse', DOCTR_WORKING_BRANCH)
+            assert git('rev-parse', second + '^') == first
+            assert git('ls-tree', '-r', '--name-only', second).split() == [
+                '.nojekyll', 'docs/.doctr-files', 'docs/test1']
+            assert git('show', second + ':docs/test1') == 'test1 modified'
+            git('branch', '-f', 'gh-pages', second)
+
+            # No changes
+            assert not commit_docs_plumbing('src', 'docs', 'gh-pages', parent='gh-pages')
+
+            with open(join('src', 'logo.png'), 'wb') as f:
+                f.write(b'\x89PNG')
+            assert commit_docs_plumbing('src', 'docs', 'gh-pages',
+                parent='gh-pages', gitattributes=True)
+            third = git('rev-parse', DOCTR_WORKING_BRANCH)
+            assert '*.png -delta' in git('show', third + ':.gitattributes').splitlines()
+            git('branch', '-f', 'gh-pages', third)
+            os.remove(join('src', 'logo.png'))
+
+            # The current checkout was never touched
+            assert git('rev-parse', 'HEAD') == build_head
+            assert git('status', '--porcelain', '--untracked-files=no') == ''
+            assert not os.path.exists('docs')
+        finally:
+            os.chdir(old_curdir)
+
+def test_analyze_deploy(deploy_repos):
+    os.makedirs(join('html', '_images'))
+    for name, size in [('index.html', 100), ('search.html', 50),
+        (join('_images', 'plot.PNG'), 1000), ('objects.inv', 10)]:
+        with open(join('html', name), 'wb') as f:
+            f.write(b'x'*size)
+    assert commit_docs_plumbing('html', 'docs', 'gh-pages')
+    first = git('rev-parse', DOCTR_WORKING_BRANCH)
+    git('branch', 'gh-pages', first)
+
+    stats = analyze_deploy(first, 'docs', largest=2)
+    assert stats['files'] == 4
+    assert stats['bytes'] == stats['growth'] == stats['added_bytes'] == 1160
+    assert stats['previous_bytes'] == 0
+    assert stats['largest'] == [{'path': 'docs/_images/plot.PNG', 'bytes': 1000},
+        {'path': 'docs/index.html', 'bytes': 100}]
+    assert stats['extensions'] == {'.html': {'files': 2, 'bytes': 150},
+        '.inv': {'files': 1, 'bytes': 10}, '.png': {'files': 1, 'bytes': 1000}}
+    assert 'docs/_images/plot.PNG' in format_deploy_stats(stats)
+
+    # An accidental duplication of the images
+    shutil.copytree(join('html', '_images'), join('html', '_images2'))
+    with open(join('html', 'index.html'), 'wb') as f:
+        f.write(b'y'*100)
+    assert commit_docs_plumbing('html', 'docs', 'gh-pages', parent='gh-pages')
+    second = git('rev-parse', DOCTR_WORKING_BRANCH)
+    stats = analyze_deploy(second, 'docs', previous=first)
+    assert stats['bytes'] == 2160
+    assert stats['previous_bytes'] == 1160
+    assert stats['growth'] == 1000
+    assert stats['added_bytes'] == 1100
+
+    assert check_deploy_budgets(stats) == []
+    assert check_deploy_budgets(stats, max_deploy_size=3000, max_growth=1000) == []
+    assert len(check_deploy_budgets(stats, max_deploy_size=2000, max_growth=999)) == 2
+
+def test_git_hash_objects_no_filters(deploy_repos):
+    # The attributes of the build repository don't apply to the built docs
+    with open('.gitattributes', 'w') as f:
+        f.write('*.txt text eol=lf\n')
+    os.makedirs('html')
+    with open(join('html', 'crlf.txt'), 'wb') as f:
+        f.write(b'line 1\r\nline 2\r\n')
+
+    path = join('html', 'crlf.txt')
+    assert travis.git_hash_objects([path]) == [git_blob_hash(path)]
+    # The line endings were not converted
+    assert git('cat-file', '-s', git_blob_hash(path)) == '16'
+
+def test_checkout_deploy_worktree(deploy_repos):
+    head = git('rev-parse', 'HEAD')
+    with open('ignored', 'w') as f:
+        f.write('untracked file')
+
+    # The deploy branch doesn't exist yet
+    worktree = checkout_deploy_worktree('gh-pages')
+    assert sorted(os.listdir(worktree)) == ['.git', '.nojekyll']
+    remove_deploy_worktree(worktree)
+    assert not os.path.exists(worktree)
+
+    git('push', '-q', 'doctr_remote', DOCTR_WORKING_BRANCH + ':gh-pages')
+    git('fetch', '-q', 'doctr_remote')
+
+    worktree = checkout_deploy_worktree('gh-pages')
+    try:
+        assert git('-C', worktree, 'rev-parse', 'HEAD') == git('rev-parse', 'doctr_remote/gh-pages')
+        assert git('-C', worktree, 'symbolic-ref', '--short', 'HEAD') == DOCTR_WORKING_BRANCH
+    finally:
+        remove_deploy_worktree(worktree)
+
+    # The build checkout was never touched
+    assert git('rev-parse', 'HEAD') == head
+    assert sorted(os.listdir('.')) == ['.git', 'README', 'ignored']
+    assert git('worktree', 'list').count('\n') == 0
+
+def test_fetch_deploy_branch_and_push(deploy_repos):
+    push_to_deploy_repo(deploy_repos, 'a')
+    push_to_deploy_repo(deploy_repos, 'b')
+
+    assert not fetch_deploy_branch('gh-pages-nonexistent')
+    assert fetch_deploy_branch('gh-pages')
+    assert git('rev-parse', '--is-shallow-repository') == 'true'
+    assert git('rev-list', '--count', 'doctr_remote/gh-pages') == '1'
+    assert git('ls-tree', '--name-only', 'doctr_remote/gh-pages').split() == ['a', 'b']
+
+    worktree = checkout_deploy_worktree('gh-pages')
+    try:
+        os.chdir(worktree)
+        with open('c', 'w') as f:
+            f.write('c')
+        assert commit_docs(added=['c'], removed=[])
+
+        # Another build pushed in the meantime, so the first push fails and
+        # the retry has to work against the shallow history.
+        push_to_deploy_repo(deploy_repos, 'd')
+        attempts = push_docs('gh-pages', backoff=0.01)
+    finally:
+        os.chdir(join(deploy_repos, 'build'))
+        remove_deploy_worktree(worktree)
+
+    assert [a['pushed'] for a in attempts] == [False, True]
+    deploy_git = ['--git-dir', join(deploy_repos, 'deploy.git')]
+    assert git(*deploy_git, 'ls-tree', '--name-only', 'gh-pages').split() == ['a', 'b', 'c', 'd']
+    # The history is linear: our changes are a single new commit on top of
+    # the one from the other build
+    assert git(*deploy_git, 'log', '--format=%s', 'gh-pages').splitlines() == [
+        git('log', '-1', '--format=%s', DOCTR_WORKING_BRANCH),
+        'Add d', 'Add b', 'Add a']
+
+def test_fetch_deploy_branch_filter_blobs(deploy_repos):
+    push_to_deploy_repo(deploy_repos, 'a')
+
+    def missing():
+        return [i for i in git('rev-list', '--objects', '--missing=print',
+            'doctr_remote/gh-pages').split() if i.startswith('?')]
+
+    assert fetch_deploy_branch('gh-pages')
+    if travis.get_git_version() >= (2, 29):
+        assert len(missing()) == 1
+        git('config', '--unset', 'remote.doctr_remote.partialclonefilter')
+
+    # Like doctr prefetch
+    git('update-ref', '-d', 'refs/remotes/doctr_remote/gh-pages')
+    assert fetch_deploy_branch('gh-pages', filter_blobs=False)
+    assert missing() == []
+
+def test_fetch_missing_blobs(deploy_repos, capsys):
+    if travis.get_git_version() < (2, 29):
+        pytest.skip("blob:none fetches need git 2.29")
+    for name in ['a', 'b', 'c']:
+        push_to_deploy_repo(deploy_repos, join('docs', name))
+    fetch_deploy_branch('gh-pages')
+
+    def missing():
+        return [i for i in git('rev-list', '--objects', '--missing=print',
+            'doctr_remote/gh-pages').split() if i.startswith('?')]
+    assert len(missing()) == 3
+
+    # The manifest-less deploy directory needs the sizes of all the blobs,
+    # which are fetched together
+    capsys.readouterr()
+    files = travis.get_deploy_files('doctr_remote/gh-pages', 'docs')
+    assert '(3 blobs)' in capsys.readouterr().out
+    assert missing() == []
+    assert sorted(files) == [join('docs', name) for name in ['a', 'b', 'c']]
+    assert [size for hash, size in files.values()] == [6, 6, 6]
+
+def test_deploy_mirror(deploy_repos):
+    cache_dir = join(deploy_repos, 'cache')
+    push_to_deploy_repo(deploy_repos, 'a')
+
+    mirror = get_deploy_mirror(cache_dir, 'drdoctr/doctr')
+    assert mirror == join(cache_dir, 'drdoctr-doctr.git')
+    assert fetch_deploy_branch('gh-pages', mirror=mirror)
+    assert git('ls-tree', '--name-only', 'doctr_remote/gh-pages').split() == ['a']
+    with open(join('.git', 'objects', 'info', 'alternates')) as f:
+        assert f.read() == join(mirror, 'objects') + '\n'
+    assert glob.glob(join(mirror, 'objects', 'pack', '*.bitmap'))
+    assert os.path.exists(join(mirror, 'objects', 'info', 'commit-graphs'))
+
+    # A later build only fetches the new commit into the existing mirror
+    push_to_deploy_repo(deploy_repos, 'b')
+    assert get_deploy_mirror(cache_dir, 'drdoctr/doctr') == mirror
+    assert fetch_deploy_branch('gh-pages', mirror=mirror)
+    assert git('ls-tree', '--name-only', 'doctr_remote/gh-pages').split() == ['a', 'b']
+    assert git('rev-list', '--count', 'doctr_remote/gh-pages') == '2'
+    assert git('count-objects', '-v').count('\nsize-pack: 0\n') == 1
+
+    # A corrupt mirror is created again
+    for pack in glob.glob(join(mirror, 'objects', 'pack', '*')):
+        os.remove(pack)
+    assert get_deploy_mirror(cache_dir, 'drdoctr/doctr') == mirror
+    assert not os.path.exists(join(mirror, 'refs', 'heads', 'gh-pages'))
+    assert fetch_deploy_branch('gh-pages', mirror=mirror)
+    assert git('--git-dir', mirror, 'rev-parse', 'gh-pages') == git('rev-parse', 'doctr_remote/gh-pages')
+
+def test_prefetch_state(deploy_repos, monkeypatch):
+    monkeypatch.setenv('TRAVIS_JOB_ID', '1234')
+    monkeypatch.setenv('SSH_AUTH_SOCK', '/tmp/ssh-agent.sock')
+    assert load_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='deploy_key') is None
+
+    save_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='deploy_key',
+        canpush=True)
+    assert os.path.exists(join('.git', 'doctr-prefetch.json'))
+    monkeypatch.delenv('SSH_AUTH_SOCK')
+
+    assert load_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='token') is None
+    assert load_prefetch_state('drdoctr/doctr', 'master', auth_type='deploy_key') is None
+    assert 'SSH_AUTH_SOCK' not in os.environ
+    assert load_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='deploy_key') is True
+    assert os.environ['SSH_AUTH_SOCK'] == '/tmp/ssh-agent.sock'
+
+    # The state is only used in the same job
+    monkeypatch.setenv('TRAVIS_JOB_ID', '1235')
+    assert load_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='deploy_key') is None
+
+    # doctr_remote was pointed to another repository by another deploy
+    monkeypatch.setenv('TRAVIS_JOB_ID', '1234')
+    git('remote', 'set-url', 'doctr_remote', join(deploy_repos, 'other.git'))
+    assert load_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='deploy_key') is None
+    git('remote', 'set-url', 'doctr_remote', join(deploy_repos, 'deploy.git'))
+    assert load_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='deploy_key') is True
+    git('remote', 'set-url', '--push', 'doctr_remote', join(deploy_repos, 'other.git'))
+    assert load_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='deploy_key') is None
+
+def test_setup_GitHub_push_skip_if_cannot_push(deploy_repos, monkeypatch):
+    class FakeResponse:
+        status_code = 200
+        def json(self):
+            return {'fork': False}
+    monkeypatch.setattr(travis.requests, 'get', lambda url: FakeResponse())
+    monkeypatch.setenv('TRAVIS_REPO_SLUG', 'drdoctr/doctr')
+    monkeypatch.setenv('TRAVIS_BRANCH', 'master')
+    monkeypatch.setenv('TRAVIS_PULL_REQUEST', '1')
+    url = git('remote', 'get-url', 'doctr_remote')
+
+    assert setup_GitHub_push('drdoctr/doctr', skip_if_cannot_push=True) is False
+    # Nothing was set up or fetched
+    assert git('remote', 'get-url', 'doctr_remote') == url
+    assert git('for-each-ref', 'refs/remotes') == ''
+
+def test_use_origin_for_fetch(deploy_repos):
+    deploy_url = join(deploy_repos, 'deploy.git')
+    push_to_deploy_repo(deploy_repos, 'a')
+    git('remote', 'add', 'origin', deploy_url)
+    git('fetch', '-q', 'origin', '+gh-pages:refs/remotes/origin/gh-pages')
+    push_to_deploy_repo(deploy_repos, 'b')
+
+    use_origin_for_fetch('gh-pages', 'git@github.com:drdoctr/doctr.git')
+    assert git('remote', 'get-url', 'doctr_remote') == deploy_url
+    assert git('remote', 'get-url', '--push', 'doctr_remote') == 'git@github.com:drdoctr/doctr.git'
+    assert git('rev-parse', 'doctr_remote/gh-pages') == git('rev-parse', 'origin/gh-pages')
+
+    # Only the new commit is fetched
+    assert fetch_deploy_branch('gh-pages')
+    assert git('rev-list', '--count', 'origin/gh-pages..doctr_remote/gh-pages') == '1'
+    assert git('ls-tree', '--name-only', 'doctr_remote/gh-pages').split() == ['a', 'b']
+
+# git before 2.35 needs 'sparse-checkout init --cone' before 'sparse-checkout set'
+@pytest.mark.parametrize("git_version", [None, (2, 34, 1)])
+def test_checkout_deploy_worktree_sparse(deploy_repos, monkeypatch, git_version):
+    if git_version:
+        monkeypatch.setattr(travis, 'get_git_version', lambda: git_version)
+    push_to_deploy_repo(deploy_repos, 'index.html')
+    push_to_deploy_repo(deploy_repos, 'v1/a')
+    push_to_deploy_repo(deploy_repos, 'v2/b')
+    assert fetch_deploy_branch('gh-pages')
+
+    worktree = checkout_deploy_worktree('gh-pages', sparse_dir='v2')
+    try:
+        assert sorted(os.listdir(worktree)) == ['.git', 'index.html', 'v2']
+        os.chdir(worktree)
+        assert git('status', '--porcelain') == ''
+        with open(join('v2', 'c'), 'w') as f:
+            f.write('c')
+        assert commit_docs(added=[join('v2', 'c')], removed=[])
+    finally:
+        os.chdir(join(deploy_repos, 'build'))
+        remove_deploy_worktree(worktree)
+
+    # The files outside of the sparse checkout are still in the commit
+    assert git('ls-tree', '-r', '--name-only', DOCTR_WORKING_BRANCH).split() == [
+        'index.html', 'v1/a', 'v2/b', 'v2/c']
+    # and the build checkout isn't sparse
+    assert git('config', '--type=bool', '--default=false', 'core.sparseCheckout') == 'false'
+    assert sorted(os.listdir('.')) == ['.git', 'README']
+
+def test_replay_commit(deploy_repos):
+    for name in ['a', 'b', 'c']:
+        with open(name, 'w') as f:
+            f.write(name)
+    git('add', 'a', 'b', 'c')
+    git('commit', '-q', '-m', 'base')
+    base = git('rev-parse', 'HEAD')
+
+    git('checkout', '-q', '-b', 'ours')
+    os.remove('a')
+    with open('b', 'w') as f:
+        f.write('ours')
+    os.makedirs('dir')
+    with open(join('dir', 'new'), 'w') as f:
+        f.write('new')
+    git('add', '-A')
+    git('commit', '-q', '-m', 'ours')
+
+    git('checkout', '-q', '-b', 'theirs', base)
+    with open('c', 'w') as f:
+        f.write('theirs')
+    with open('b', 'w') as f:
+        f.write('theirs')
+    git('commit', '-q', '-am', 'theirs')
+
+    replayed = replay_commit('ours', 'theirs')
+    assert git('rev-parse', replayed + '^@') == git('rev-parse', 'theirs')
+    assert git('log', '-1', '--format=%s', replayed) == 'ours'
+    assert git('ls-tree', '-r', '--name-only', replayed).split() == [
+        'README', 'b', 'c', join('dir', 'new')]
+    assert git('show', replayed + ':b') == 'ours'
+    assert git('show', replayed + ':c') == 'theirs'
+
+    # Nothing left to replay
+    assert replay_commit('ours', replayed) is None
+
+    # The branch doesn't exist anymore, so every path of the commit is kept
+    replayed = replay_commit('ours', None)
+    assert git('rev-list', '--parents', replayed) == replayed
+    assert git('rev-parse', replayed + '^{tree}') == git('rev-parse', 'ours^{tree}')
+
+def test_push_docs_deleted_branch(deploy_repos):
+    push_to_deploy_repo(deploy_repos, 'a')
+    fetch_deploy_branch('gh-pages')
+    os.makedirs('html')
+    with open(join('html', 'index.html'), 'w') as f:
+        f.write('index')
+    assert commit_docs_plumbing('html', 'docs', 'gh-pages', parent='doctr_remote/gh-pages')
+
+    # The deploy branch was deleted before the push
+    deploy_git = ['--git-dir', join(deploy_repos, 'deploy.git')]
+    git(*deploy_git, 'branch', '-D', 'gh-pages')
+    attempts = push_docs('gh-pages', backoff=0.01)
+    assert [a['pushed'] for a in attempts] == [False, True]
+    assert git(*deploy_git, 'ls-tree', '-r', '--name-only', 'gh-pages').split() == [
+        'a', 'docs/.doctr-files', 'docs/index.html']
+
+def test_push_docs_atomic(deploy_repos):
+    push_to_deploy_repo(deploy_repos, 'a')
+    assert fetch_deploy_branches(['gh-pages', 'versions']) == {'gh-pages'}
+
+    os.makedirs('html')
+    with open(join('html', 'index.html'), 'w') as f:
+        f.write('index')
+    with open('versions.json', 'w') as f:
+        f.write('["dev"]')
+    assert commit_docs_plumbing('html', 'dev', 'gh-pages')
+    assert commit_docs_plumbing('versions.json', '.', 'versions',
+        branch='versions-working-branch')
+    branches = {'gh-pages': DOCTR_WORKING_BRANCH, 'versions': 'versions-working-branch'}
+
+    # Another build pushed to gh-pages, so neither branch is updated
+    push_to_deploy_repo(deploy_repos, 'b')
+    with pytest.raises(SystemExit):
+        push_docs('gh-pages', retries=0, branches=branches)
+    deploy_git = ['--git-dir', join(deploy_repos, 'deploy.git')]
+    assert git(*deploy_git, 'branch', '--list', 'versions') == ''
+
+    attempts = push_docs('gh-pages', branches=branches, backoff=0.01)
+    assert [a['pushed'] for a in attempts] == [False, True]
+    assert git(*deploy_git, 'ls-tree', '-r', '--name-only', 'gh-pages').split() == [
+        'a', 'b', 'dev/.doctr-files', 'dev/index.html']
+    assert git(*deploy_git, 'ls-tree', '-r', '--name-only', 'versions').split() == [
+        '.doctr-files', '.nojekyll', 'versions.json']
+
+def test_fetch_deploy_branches_keeps_history(deploy_repos):
+    for name in ['a', 'b']:
+        push_to_deploy_repo(deploy_repos, name)
+    # Like --cache-dir, or the reuse of origin
+    assert fetch_deploy_branch('gh-pages', depth=None)
+    push_to_deploy_repo(deploy_repos, 'c')
+    push_to_deploy_repo(deploy_repos, 'index.json', branch='versions')
+    push_to_deploy_repo(deploy_repos, 'index2.json', branch='versions')
+
+    assert fetch_deploy_branches(['gh-pages', 'versions']) == {'gh-pages', 'versions'}
+    # The new branch is shallow, but gh-pages keeps its whole history
+    assert git('rev-list', '--count', 'doctr_remote/gh-pages') == '3'
+    assert git('rev-list', '--count', 'doctr_remote/versions') == '1'
+
+@pytest.mark.parametrize("engine", ['plumbing', 'worktree'])
+def test_deploy_pushes_by_default(deploy_repos, monkeypatch, engine):
+    from ..__main__ import get_parser
+
+    monkeypatch.setenv('TRAVIS_JOB_ID', '1234')
+    git('remote', 'add', 'origin', 'https://github.com/drdoctr/doctr.git')
+    push_to_deploy_repo(deploy_repos, 'a')
+    push_to_deploy_repo(deploy_repos, 'index.json', branch='versions')
+    fetch_deploy_branch('gh-pages')
+    # Reuse this setup instead of setting up the push to GitHub
+    save_prefetch_state('drdoctr/doctr', 'gh-pages', auth_type='deploy_key',
+        canpush=True)
+
+    os.makedirs('html')
+    with open(join('html', 'index.html'), 'w') as f:
+        f.write('index')
+    with open('versions.json', 'w') as f:
+        f.write('["dev"]')
+
+    parser = get_parser(config={})
+    args = parser.parse_args(['deploy', '--force', '--sync', '--engine', engine,
+        '--built-docs', 'html', '--also-deploy', 'versions', 'versions.json',
+        '.', 'dev'])
+    args.func(args, parser)
+
+    deploy_git = ['--git-dir', join(deploy_repos, 'deploy.git')]
+    gh_pages = git(*deploy_git, 'ls-tree', '-r', '--name-only', 'gh-pages').split()
+    versions = git(*deploy_git, 'ls-tree', '-r', '--name-only', 'versions').split()
+    assert 'dev/index.html' in gh_pages
+    assert 'versions.json' in versions
+    # There are no compressed files, so there is no .gitattributes
+    assert '.gitattributes' not in gh_pages + versions
+
+def test_truncate_history(deploy_repos):
+    for name in ['a', 'b', 'c']:
+        git('commit', '-q', '--allow-empty', '-m', name)
+    head = git('rev-parse', 'HEAD')
+
+    single = truncate_history(head, 1)
+    assert git('rev-list', single) == single
+    assert git('rev-parse', single + '^{tree}') == git('rev-parse', head + '^{tree}')
+    assert git('log', '--format=%s%x00%an%x00%ad', single) == git('log', '-1',
+        '--format=%s%x00%an%x00%ad', head)
+
+    two = truncate_history(head, 2)
+    assert git('log', '--format=%s', two).split() == ['c', 'b']
+    # Already short enough
+    assert truncate_history(two, 2) == two
+    assert len(git('rev-list', truncate_history(head, 10)).split()) == 4
+
+def test_push_docs_keep_history(deploy_repos):
+    for name in ['a', 'b', 'c']:
+        push_to_deploy_repo(deploy_repos, name)
+    assert fetch_deploy_branch('gh-pages', depth=2)
+
+    def deploy(name):
+        worktree = checkout_deploy_worktree('gh-pages')
+        try:
+            os.chdir(worktree)
+            with open(name, 'w') as f:
+                f.write(name)
+            assert commit_docs(added=[name], removed=[])
+        finally:
+            os.chdir(join(deploy_repos, 'build'))
+            remove_deploy_worktree(worktree)
+
+    deploy_git = ['--git-dir', join(deploy_repos, 'deploy.git')]
+    deploy('d')
+    push_docs('gh-pages', keep_history=2, archive_ref='refs/doctr/archive')
+    assert git(*deploy_git, 'log', '--format=%s', 'gh-pages').splitlines()[1:] == ['Add c']
+    assert git(*deploy_git, 'log', '--format=%s', 'refs/doctr/archive').splitlines() == ['Add c']
+
+    # Another build pushed, so the lease fails and the commit is replayed
+    git('fetch', '-q', 'doctr_remote', '+gh-pages:refs/remotes/doctr_remote/gh-pages')
+    deploy('e')
+    push_to_deploy_repo(deploy_repos, 'f')
+    attempts = push_docs('gh-pages', keep_history=2, archive_ref='refs/doctr/archive',
+        backoff=0.01)
+    assert [a['pushed'] for a in attempts] == [False, True]
+    assert git(*deploy_git, 'log', '--format=%s', 'gh-pages').splitlines()[1:] == ['Add f']
+    assert git(*deploy_git, 'ls-tree', '--name-only', 'gh-pages').split() == [
+        'a', 'b', 'c', 'd', 'e', 'f']
+    assert git(*deploy_git, 'log', '--format=%s', 'refs/doctr/archive').splitlines() == [
+        'Add f', 'Add c']
+
+def test_split_commit_and_chunked_push(deploy_repos):
+    push_to_deploy_repo(deploy_repos, 'old')
+    assert fetch_deploy_branch('gh-pages')
+    worktree = checkout_deploy_worktree('gh-pages')
+    try:
+        os.chdir(worktree)
+        os.remove('old')
+        for name in ['a', 'b', 'c', 'd', 'e']:
+            with open(name, 'w') as f:
+                f.write(name*100)
+        with open('big', 'w') as f:
+            f.write('x'*1000)
+        assert commit_docs(added=['a', 'b', 'c', 'd', 'e', 'big'], removed=['old'])
+    finally:
+        os.chdir(join(deploy_repos, 'build'))
+        remove_deploy_worktree(worktree)
+
+    commits = split_commit(DOCTR_WORKING_BRANCH, 'doctr_remote/gh-pages', 250)
+    assert [git('diff-tree', '-r', '--name-only', '--no-commit-id', c).split()
+        for c in commits] == [['a', 'b'], ['big'], ['c', 'd'], ['e', 'old']]
+    assert git('rev-parse', commits[-1] + '^{tree}') == git('rev-parse', DOCTR_WORKING_BRANCH + '^{tree}')
+    assert git('log', '-1', '--format=%b', commits[0]).endswith('Part 1 of 4')
+
+    # Resuming skips what is already on the remote
+    git('push', '-q', 'doctr_remote', commits[1] + ':refs/heads/gh-pages')
+    assert fetch_deploy_branch('gh-pages')
+    remaining = split_commit(DOCTR_WORKING_BRANCH, 'doctr_remote/gh-pages', 250)
+    assert [git('diff-tree', '-r', '--name-only', '--no-commit-id', c).split()
+        for c in remaining] == [['c', 'd'], ['e', 'old']]
+
+    git('fetch', '-q', 'doctr_remote', '+gh-pages:refs/remotes/doctr_remote/gh-pages')
+    attempts = push_docs('gh-pages', max_push_size=250, backoff=0.01)
+    # The push of the first part fails, since the first two parts are
+    # already on the remote.
+    assert [a['pushed'] for a in attempts] == [False, True, True]
+    deploy_git = ['--git-dir', join(deploy_repos, 'deploy.git')]
+    assert git(*deploy_git, 'rev-parse', 'gh-pages^{tree}') == git('rev-parse', DOCTR_WORKING_BRANCH + '^{tree}')
+    assert git(*deploy_git, 'rev-list', '--count', 'gh-pages') == '5'
+
+def test_plan_gc():
+    day = 24*60*60
+    now = 100*day
+    deploy_dirs = {
+        'tag-v1': {'changed': str(10*day), 'tag': 'v1'},
+        'tag-v2': {'changed': str(20*day), 'tag': 'v2'},
+        'tag-v3': {'changed': str(95*day), 'tag': 'v3'},
+        'docs-master': {'changed': str(99*day), 'branch': 'master'},
+        'docs-feature': {'changed': str(50*day), 'branch': 'feature'},
+        # Deployed by an older doctr
+        'old': {},
+    }
+    assert plan_gc(deploy_dirs, now=now) == {}
+    assert list(plan_gc(deploy_dirs, keep_tags=2, now=now)) == ['tag-v1']
+    assert list(plan_gc(deploy_dirs, keep_tags=0, now=now)) == ['tag-v1',
+        'tag-v2', 'tag-v3']
+    assert list(plan_gc(deploy_dirs, existing_branches={'master'},
+        now=now)) == ['docs-feature']
+    assert list(plan_gc(deploy_dirs, max_age=60, now=now)) == ['tag-v1', 'tag-v2']
+    assert plan_gc(deploy_dirs, keep_tags=1, existing_branches={'master',
+        'feature'}, max_age=30, now=now) == {
+            'docs-feature': 'unchanged for 50 days',
+            'tag-v1': 'unchanged for 90 days',
+            'tag-v2': 'unchanged for 80 days',
+        }
+
+    # A stable alias deployed on the tag builds doesn't take the place of a tag
+    deploy_dirs['stable'] = {'changed': str(95*day), 'tag': 'v3'}
+    assert list(plan_gc(deploy_dirs, keep_tags=2, now=now)) == ['tag-v1']
+    assert list(plan_gc(deploy_dirs, keep_tags=0, now=now)) == ['stable',
+        'tag-v1', 'tag-v2', 'tag-v3']
+
+def test_gc(deploy_repos):
+    os.makedirs('html')
+    with open(join('html', 'index.html'), 'w') as f:
+        f.write('index')
+
+    deploys = [
+        ('.', [('changed', '1'), ('branch', 'master')]),
+        ('docs-master', [('changed', '1'), ('branch', 'master')]),
+        ('docs-feature', [('changed', '2'), ('branch', 'feature')]),
+        ('tag-v1', [('changed', '3'), ('tag', 'v1')]),
+        ('tag-v2', [('changed', '4'), ('tag', 'v2')]),
+        # Nested in a removed directory
+        ('docs-feature/nested', [('changed', '5'), ('tag', 'v3')]),
+    ]
+    for deploy_dir, metadata in deploys:
+        fetch_deploy_branch('gh-pages')
+        assert commit_docs_plumbing('html', deploy_dir, 'gh-pages',
+            metadata=metadata)
+        push_docs('gh-pages')
+
+    fetch_deploy_branch('gh-pages')
+    ref = 'doctr_remote/gh-pages'
+    # Unchanged docs keep the metadata of the deploy that changed them
+    assert not commit_docs_plumbing('html', 'tag-v2', 'gh-pages',
+        metadata=[('changed', '10'), ('tag', 'v2')])
+
+    deploy_dirs = find_deploy_dirs(ref)
+    assert deploy_dirs == {
+        'docs-master': {'changed': '1', 'branch': 'master'},
+        'docs-feature': {'changed': '2', 'branch': 'feature'},
+        'tag-v1': {'changed': '3', 'tag': 'v1'},
+        'tag-v2': {'changed': '4', 'tag': 'v2'},
+        'docs-feature/nested': {'changed': '5', 'tag': 'v3'},
+    }
+    remove = plan_gc(deploy_dirs, keep_tags=2, existing_branches={'master'})
+    assert list(remove) == ['docs-feature', 'tag-v1']
+
+    assert commit_gc(ref, deploy_dirs, remove) == 4
+    assert git('log', '-1', '--format=%s', DOCTR_WORKING_BRANCH) == \
+        'Remove 2 old deploy directories with doctr gc'
+    push_docs('gh-pages')
+    deploy_git = ['--git-dir', join(deploy_repos, 'deploy.git')]
+    assert git(*deploy_git, 'ls-tree', '-r', '--name-only', 'gh-pages').split() == [
+        '.doctr-files', '.nojekyll', 'docs-feature/nested/.doctr-files',
+        'docs-feature/nested/index.html', 'docs-master/.doctr-files',
+        'docs-master/index.html', 'index.html', 'tag-v2/.doctr-files',
+        'tag-v2/index.html']
+
+def test_update_gitattributes():
+    assert get_binary_patterns(['index.html', '_images/a.PNG', 'b.png',
+        'fonts/x.woff2', 'notebook.ipynb']) == ['*.png', '*.woff2']
+
+    # No empty block is added when there are no compressed files
+    assert update_gitattributes('', []) == ''
+    assert update_gitattributes('*.html text\n', []) == '*.html text\n'
+
+    text = update_gitattributes('', ['*.png'])
+    assert text == GITATTRIBUTES_BEGIN + '\n*.png -delta\n' + GITATTRIBUTES_END + '\n'
+    assert update_gitattributes(text, ['*.png']) == text
+
+    # The patterns of other deploys and the user's own attributes are kept
+    user_text = '*.html text\n' + text + '*.sh eol=lf\n'
+    assert update_gitattributes(user_text, ['*.zip']) == (
+        '*.html text\n' + GITATTRIBUTES_BEGIN + '\n*.png -delta\n*.zip -delta\n'
+        + GITATTRIBUTES_END + '\n*.sh eol=lf\n')
+
+def test_push_pack_benchmark(deploy_repos):
+    # Benchmark of the pack generation when pushing already compressed files,
+    # with and without the -delta attributes.
+    for i in range(100):
+        with open('%03d.png' % i, 'wb') as f:
+            f.write(os.urandom(10000))
+    with open('.gitattributes', 'w') as f:
+        f.write(update_gitattributes('', get_binary_patterns(os.listdir('.'))))
+    git('add', '.')
+    git('commit', '-q', '-m', 'images')
+    head = git('rev-parse', 'HEAD')
+
+    def pack(config):
+        t0 = time.perf_counter()
+        subprocess.run(['git', *config, 'pack-objects', '--revs', '--stdout',
+            '--window=250'], input=head.encode('utf-8'), stdout=subprocess.DEVNULL,
+            check=True)
+        return time.perf_counter() - t0
+
+    # Move the attributes out of the working tree, so that only
+    # core.attributesFile from get_push_config() applies.
+    os.rename('.gitattributes', join('..', 'attributes'))
+    without = pack([])
+    with_attributes = pack(get_push_config(head))
+    print("Pack generation: %.3f s without -delta, %.3f s with -delta"
+        % (without, with_attributes))
+
+    # The timings depend on the machine, so only check that the attributes
+    # apply when pushing
+    git('rm', '-q', '--cached', '.gitattributes')
+    def delta(config):
+        return git(*config, 'check-attr', 'delta', '--', '000.png')
+    assert delta([]) == '000.png: delta: unspecified'
+    assert delta(get_push_config(head)) == '000.png: delta: unset'
+
+@pytest.mark.parametrize("path, excluded", [
+    ('a', True),
+    ('a/c', True),
+    ('ab', False),
+    ('x', False),
+    ('x/y/z', True),
+    ('x/yy', False),
+    ('notebooks/n.ipynb', True),
+    ('n.ipynb.html', False),
+    ('_sources/k.txt', True),
+    ('_sources/a/b/k.txt', True),
+    ('api/_sources/k.txt', False),
+    ('_images/big/1.png', True),
+])
+def test_compile_exclude(path, excluded):
+    patterns = ['a', 'a/b', 'x/y', '*.ipynb', '_sources/**/*.txt', '_ima?es/big']
+    assert compile_exclude(patterns)(path) == excluded
+
+def test_walk_built_docs():
+    with tempfile.TemporaryDirectory() as dir:
+        for name in ['index.html', '.buildinfo', join('_images', 'a.png'),
+                     join('notebooks', 'n.ipynb'), join('notebooks', 'n.html')]:
+            os.makedirs(os.path.dirname(join(dir, name)), exist_ok=True)
+            with open(join(dir, name), 'w') as f:
+                f.write(name)
+
+        assert walk_built_docs(dir, exclude=['_images', '*.ipynb']) == [
+            'index.html',
+            join('notebooks', ''),
+            join('notebooks', 'n.html'),
+        ]
+
+        assert walk_built_docs(join(dir, 'index.html')) == ['index.html']
+
+@pytest.mark.parametrize("copy_mode", COPY_MODES)
+def test_make_copier(copy_mode):
+    with tempfile.TemporaryDirectory() as dir:
+        src, dst = join(dir, 'src'), join(dir, 'dst')
+        with open(src, 'w') as f:
+            f.write('test1')
+        os.chmod(src, 0o755)
+        with open(dst, 'w') as f:
+            f.write('old contents')
+
+        make_copier(copy_mode)(src, dst)
+
+        with open(dst) as f:
+            assert f.read() == 'test1'
+        assert os.stat(dst).st_mode & 0o777 == 0o755
+        if copy_mode == 'hardlink':
+            assert os.path.samefile(src, dst)
+        else:
+            assert not os.path.samefile(src, dst)
+
+    with pytest.raises(ValueError):
+        make_copier('symlink')
+
+def test_make_copier_auto_fallback(monkeypatch):
+    # Strategies that fail after creating dst, like a reflink on a
+    # filesystem that doesn't support it
+    def fail(src, dst):
+        open(dst, 'wb').close()
+        raise OSError("not supported")
+    monkeypatch.setattr(travis, '_reflink', fail)
+    monkeypatch.setattr(travis, '_copy_file_range', fail)
+
+    with tempfile.TemporaryDirectory() as dir:
+        copy = make_copier('auto')
+        for name in ['test1', 'test2']:
+            src, dst = join(dir, name), join(dir, name + '-copy')
+            with open(src, 'w') as f:
+                f.write(name)
+            copy(src, dst)
+            # The hard link fallback works every time
+            assert os.path.samefile(src, dst)
+
+def test_is_deploy_job(monkeypatch):
+    monkeypatch.delenv('TRAVIS_JOB_NUMBER', raising=False)
+    assert get_travis_job_number() is None
+    assert is_deploy_job(None)
+    assert is_deploy_job(2)
+
+    monkeypatch.setenv('TRAVIS_JOB_NUMBER', '123.2')
+    assert get_travis_job_number() == 2
+    assert is_deploy_job(None)
+    assert is_deploy_job(2)
+    assert not is_deploy_job(1)
+    assert not is_deploy_job(12)
+
 @pytest.mark.parametrize("""branch_whitelist, TRAVIS_BRANCH,
                          TRAVIS_PULL_REQUEST, TRAVIS_TAG, fork, build_tags,
                          canpush""",
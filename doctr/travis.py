@@ -12,6 +12,11 @@ import re
 import pathlib
 import tempfile
 import time
+import hashlib
+import concurrent.futures
+import threading
+import json
+import random
 
 import requests
 
@@ -89,17 +94,20 @@ def setup_deploy_key(keypath='github_deploy_key', key_ext='.enc', env_name='DOCT
     AUTH_SOCK = agent_info[0].split('=')[1][:-1]
     AGENT_PID = agent_info[3].split('=')[1][:-1]
 
-    os.putenv('SSH_AUTH_SOCK', AUTH_SOCK)
-    os.putenv('SSH_AGENT_PID', AGENT_PID)
+    # Use os.environ rather than os.putenv so that save_prefetch_state() can
+    # read these back
+    os.environ['SSH_AUTH_SOCK'] = AUTH_SOCK
+    os.environ['SSH_AGENT_PID'] = AGENT_PID
 
     run(['ssh-add', os.path.expanduser('~/.ssh/' + key_filename)])
 
-def run_command_hiding_token(args, token, shell=False):
+def run_command_hiding_token(args, token, shell=False, input=None):
     if token:
         stdout = stderr = subprocess.PIPE
     else:
         stdout = stderr = None
-    p = subprocess.run(args, stdout=stdout, stderr=stderr, shell=shell)
+    p = subprocess.run(args, stdout=stdout, stderr=stderr, shell=shell,
+        input=input)
     if token:
         # XXX: Do this in a way that is streaming
         out, err = p.stdout, p.stderr
@@ -124,7 +132,7 @@ def get_token():
     token = token.encode('utf-8')
     return token
 
-def run(args, shell=False, exit=True):
+def run(args, shell=False, exit=True, input=None, summary=None):
     """
     Run the command ``args``.
 
@@ -135,6 +143,10 @@ def run(args, shell=False, exit=True):
 
     If exit=True, it exits on nonzero returncode. Otherwise it returns the
     returncode.
+
+    ``input`` (bytes) is written to the standard input of the command. It is
+    not printed, but ``summary`` (like ``'12,345 paths'``) is printed after
+    the command if it is given.
     """
     if "GH_TOKEN" in os.environ:
         token = get_token()
@@ -146,10 +158,13 @@ def run(args, shell=False, exit=True):
     else:
         command = args
     command = command.replace(token.decode('utf-8'), '~'*len(token))
-    print(blue(command))
+    if summary:
+        print(blue("%s (%s)" % (command, summary)))
+    else:
+        print(blue(command))
     sys.stdout.flush()
 
-    returncode = run_command_hiding_token(args, token, shell=shell)
+    returncode = run_command_hiding_token(args, token, shell=shell, input=input)
 
     if exit and returncode != 0:
         sys.exit(red("%s failed: %s" % (command, returncode)))
@@ -185,7 +200,8 @@ def get_travis_branch():
 def setup_GitHub_push(deploy_repo, *, auth_type='deploy_key',
     full_key_path='github_deploy_key.enc', require_master=None,
     branch_whitelist=None, deploy_branch='gh-pages',
-    env_name='DOCTR_DEPLOY_ENCRYPTION_KEY', build_tags=False):
+    env_name='DOCTR_DEPLOY_ENCRYPTION_KEY', build_tags=False, cache_dir=None,
+    skip_if_cannot_push=False, depth=1, filter_blobs=True):
     """
     Setup the remote to push to GitHub (to be run on Travis).
 
@@ -196,6 +212,16 @@ def setup_GitHub_push(deploy_repo, *, auth_type='deploy_key',
     variable.
 
     For ``auth_type='deploy_key'``, this sets up the remote with ssh access.
+
+    If ``cache_dir`` is given, the deploy branch is fetched through a mirror
+    kept in that directory (see :func:`get_deploy_mirror`).
+
+    If ``skip_if_cannot_push`` is True and the build cannot push, this returns
+    False right after checking the push rights, without setting anything up.
+
+    ``depth`` is the number of commits of the deploy branch to fetch, and
+    ``filter_blobs`` is whether to leave the file contents out of the fetch
+    (see :func:`fetch_deploy_branch`).
     """
     # Set to the name of the tag for tag builds
     TRAVIS_TAG = os.environ.get("TRAVIS_TAG", "")
@@ -230,6 +256,10 @@ def setup_GitHub_push(deploy_repo, *, auth_type='deploy_key',
         TRAVIS_TAG=TRAVIS_TAG,
         build_tags=build_tags)
 
+    if not canpush and skip_if_cannot_push:
+        print("Don't have permission to push. Skipping the setup.")
+        return canpush
+
     print("Setting git attributes")
     set_git_user_email()
 
@@ -241,9 +271,8 @@ def setup_GitHub_push(deploy_repo, *, auth_type='deploy_key',
     if canpush:
         if auth_type == 'token':
             token = get_token()
-            run(['git', 'remote', 'add', 'doctr_remote',
-                'https://{token}@github.com/{deploy_repo}.git'.format(token=token.decode('utf-8'),
-                    deploy_repo=deploy_repo)])
+            url = 'https://{token}@github.com/{deploy_repo}.git'.format(token=token.decode('utf-8'),
+                    deploy_repo=deploy_repo)
         else:
             keypath, key_ext = full_key_path.rsplit('.', 1)
             key_ext = '.' + key_ext
@@ -256,19 +285,348 @@ def setup_GitHub_push(deploy_repo, *, auth_type='deploy_key',
                     print(yellow("Warning: GitHub's API rate limits prevented doctr from detecting if this build is a forked repo. If it is, you may ignore the 'DOCTR_DEPLOY_ENCRYPTION_KEY environment variable is not set' error that follows. If it is not, you should re-run 'doctr configure'. Note that doctr cannot deploy from fork builds due to limitations in Travis."), file=sys.stderr)
                 raise
 
-            run(['git', 'remote', 'add', 'doctr_remote',
-                'git@github.com:{deploy_repo}.git'.format(deploy_repo=deploy_repo)])
+            url = 'git@github.com:{deploy_repo}.git'.format(deploy_repo=deploy_repo)
     else:
         print('setting a read-only GitHub doctr_remote')
-        run(['git', 'remote', 'add', 'doctr_remote',
-                'https://github.com/{deploy_repo}.git'.format(deploy_repo=deploy_repo)])
+        url = 'https://github.com/{deploy_repo}.git'.format(deploy_repo=deploy_repo)
+    # Only track the deploy branch, so that nothing else is ever fetched
+    run(['git', 'remote', 'add', '-t', deploy_branch, 'doctr_remote', url])
+    if deploy_repo.lower() == get_current_repo().lower():
+        use_origin_for_fetch(deploy_branch, url)
 
+    mirror = get_deploy_mirror(cache_dir, deploy_repo) if cache_dir else None
 
     print("Fetching doctr remote")
-    run(['git', 'fetch', 'doctr_remote'])
+    fetch_deploy_branch(deploy_branch, depth=depth, mirror=mirror,
+        filter_blobs=filter_blobs)
 
     return canpush
 
+def use_origin_for_fetch(deploy_branch, push_url):
+    """
+    Make ``doctr_remote`` fetch from the URL of ``origin``, for when the deploy
+    repository is the repository being built.
+
+    The push still goes to ``push_url`` (for instance through the deploy key).
+    If ``origin/<deploy_branch>`` was already fetched (like in a full clone),
+    ``doctr_remote/<deploy_branch>`` starts from it, so that only the commits
+    after it are fetched.
+    """
+    origin_url = subprocess.check_output(['git', 'config', '--get',
+        'remote.origin.url']).decode('utf-8').strip()
+    print("The deploy repository is the build repository. Fetching from origin's URL")
+    run(['git', 'remote', 'set-url', '--push', 'doctr_remote', push_url])
+    run(['git', 'remote', 'set-url', 'doctr_remote', origin_url])
+
+    origin_ref = 'refs/remotes/origin/' + deploy_branch
+    if run(['git', 'rev-parse', '--verify', '--quiet', origin_ref], exit=False) == 0:
+        print("Starting from", origin_ref)
+        run(['git', 'update-ref', 'refs/remotes/doctr_remote/' + deploy_branch,
+            origin_ref])
+
+PREFETCH_STATE_FILE = 'doctr-prefetch.json'
+
+def get_prefetch_state_path():
+    return subprocess.check_output(['git', 'rev-parse', '--git-path',
+        PREFETCH_STATE_FILE]).decode('utf-8').strip()
+
+def get_remote_urls_hash(remote='doctr_remote'):
+    """
+    Return a hash of the fetch and push URLs of the git remote ``remote``, or
+    None if it doesn't exist.
+
+    The URLs themselves may contain a token, so they are not saved anywhere.
+    """
+    urls = []
+    for args in [[], ['--push']]:
+        p = subprocess.run(['git', 'remote', 'get-url', *args, remote],
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        if p.returncode:
+            return None
+        urls.append(p.stdout.strip())
+    return hashlib.sha256(b'\0'.join(urls)).hexdigest()
+
+def save_prefetch_state(deploy_repo, deploy_branch, *, auth_type, canpush):
+    """
+    Record that :func:`setup_GitHub_push` was run by ``doctr prefetch``, so
+    that ``doctr deploy`` can skip it (see :func:`load_prefetch_state`).
+
+    The state is saved in the ``.git`` directory, along with the ssh-agent
+    environment variables, since the agent outlives the prefetch process.
+    """
+    state = {
+        'deploy_repo': deploy_repo,
+        'deploy_branch': deploy_branch,
+        'auth_type': auth_type,
+        'canpush': canpush,
+        'TRAVIS_JOB_ID': os.environ.get('TRAVIS_JOB_ID', ''),
+        'remote_urls': get_remote_urls_hash(),
+        'env': {var: os.environ[var] for var in ['SSH_AUTH_SOCK', 'SSH_AGENT_PID']
+            if var in os.environ},
+    }
+    path = get_prefetch_state_path()
+    # Write it atomically, so that a deploy never reads a partial file
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+    print("Saved the prefetch state to", path)
+
+def load_prefetch_state(deploy_repo, deploy_branch, *, auth_type):
+    """
+    Reuse the setup from ``doctr prefetch`` if it was run for the same deploy
+    repository, branch and authentication type in this job.
+
+    Returns whether the build can push (like :func:`setup_GitHub_push`), or
+    None if there is no usable prefetch state, in which case the setup should
+    be done.
+
+    The state is not used if ``doctr_remote`` was changed since the prefetch
+    (for instance by a deploy to another repository in the same job).
+
+    The deploy branch is not fetched again. If it changed since the prefetch,
+    the push is retried like for any other concurrent push.
+    """
+    path = get_prefetch_state_path()
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        state = json.load(f)
+
+    expected = {
+        'deploy_repo': deploy_repo,
+        'deploy_branch': deploy_branch,
+        'auth_type': auth_type,
+        'TRAVIS_JOB_ID': os.environ.get('TRAVIS_JOB_ID', ''),
+    }
+    for key in expected:
+        if state.get(key) != expected[key]:
+            print("Not using the prefetch state, since it was for a different",
+                key, "(%r instead of %r)" % (state.get(key), expected[key]))
+            return None
+    remote_urls = get_remote_urls_hash()
+    if remote_urls is None:
+        print("Not using the prefetch state, since doctr_remote doesn't exist")
+        return None
+    if state.get('remote_urls') != remote_urls:
+        print("Not using the prefetch state, since doctr_remote was changed")
+        return None
+
+    print("Using the setup from doctr prefetch")
+    os.environ.update(state['env'])
+    return state['canpush']
+
+def get_git_version():
+    """
+    Return the version of git as a tuple of ints, like ``(2, 39, 5)``.
+    """
+    out = subprocess.check_output(['git', '--version']).decode('utf-8')
+    return tuple(int(i) for i in re.findall(r'\d+', out.split()[2])[:3])
+
+def fetch_deploy_branch(deploy_branch, depth=1, mirror=None, filter_blobs=True):
+    """
+    Fetch only ``deploy_branch`` from ``doctr_remote`` into
+    ``doctr_remote/<deploy_branch>``.
+
+    The first fetch is shallow (``depth`` commits, or the full history if
+    ``depth`` is None), and if ``filter_blobs`` is True, on git 2.29 and
+    newer it uses a ``blob:none`` filter, so that file contents are only
+    downloaded when something actually reads them (for instance when the
+    branch is checked out). Servers that don't support filters ignore it and
+    send the blobs. ``doctr prefetch`` passes ``filter_blobs=False``, so that
+    the contents are downloaded in the background while the docs build,
+    instead of one by one during the deploy. Later fetches (like the ones
+    when a push is retried) only get the new commits.
+
+    If ``mirror`` is given (see :func:`get_deploy_mirror`), the mirror is
+    updated from ``doctr_remote`` instead, its objects are used as alternates,
+    and the branch is fetched from it with its full history.
+
+    Returns False if the branch doesn't exist on the remote and True
+    otherwise.
+    """
+    code = run(['git', 'ls-remote', '--exit-code', '--heads', 'doctr_remote',
+        deploy_branch], exit=False)
+    if code == 2:
+        print("{} doesn't exist on doctr_remote".format(deploy_branch))
+        return False
+    elif code:
+        sys.exit(red("Could not list the branches of doctr_remote: %s" % code))
+
+    refspec = '+refs/heads/{0}:refs/remotes/doctr_remote/{0}'.format(deploy_branch)
+    if mirror:
+        update_deploy_mirror(mirror, deploy_branch)
+        add_alternate(mirror)
+        # All the objects are already available through the alternate, so
+        # this only updates the ref.
+        run(['git', 'fetch', '--no-tags', mirror, refspec])
+        return True
+
+    args = ['git', 'fetch', '--no-tags']
+    remote_ref = 'refs/remotes/doctr_remote/' + deploy_branch
+    if run(['git', 'rev-parse', '--verify', '--quiet', remote_ref], exit=False) == 0:
+        run(args + ['doctr_remote', refspec])
+        return True
+    if depth:
+        args.append('--depth={}'.format(depth))
+    if filter_blobs and get_git_version() >= (2, 29):
+        if run(args + ['--filter=blob:none', 'doctr_remote', refspec], exit=False) == 0:
+            return True
+        print("Fetching without a filter")
+    run(args + ['doctr_remote', refspec])
+    return True
+
+def fetch_deploy_branches(branches, depth=1):
+    """
+    Fetch ``branches`` from ``doctr_remote`` into ``doctr_remote/<branch>``
+    like :func:`fetch_deploy_branch` (without a mirror), with one ``git
+    fetch`` for the branches that were already fetched and one (shallow) for
+    the ones that weren't, so that the history of the former is never made
+    shallow again.
+
+    Returns the set of the branches that exist on the remote.
+    """
+    p = subprocess.run(['git', 'ls-remote', '--heads', 'doctr_remote',
+        *branches], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if p.returncode:
+        sys.exit(red("Could not list the branches of doctr_remote: %s" % p.returncode))
+    heads = {line.split()[1] for line in p.stdout.decode('utf-8').splitlines()}
+    existing = {branch for branch in branches if 'refs/heads/' + branch in heads}
+    for branch in sorted(set(branches) - existing):
+        print("{} doesn't exist on doctr_remote".format(branch))
+    if not existing:
+        return existing
+
+    def refspecs(branches):
+        return ['+refs/heads/{0}:refs/remotes/doctr_remote/{0}'.format(branch)
+            for branch in sorted(branches)]
+
+    fetched = {branch for branch in existing if run(['git', 'rev-parse',
+        '--verify', '--quiet', 'refs/remotes/doctr_remote/' + branch],
+        exit=False) == 0}
+    args = ['git', 'fetch', '--no-tags']
+    if fetched:
+        run(args + ['doctr_remote', *refspecs(fetched)])
+    if existing - fetched:
+        # Only the first fetch of a branch is shallow
+        if depth:
+            args.append('--depth={}'.format(depth))
+        if get_git_version() >= (2, 29):
+            if run(args + ['--filter=blob:none', 'doctr_remote',
+                *refspecs(existing - fetched)], exit=False) == 0:
+                return existing
+            print("Fetching without a filter")
+        run(args + ['doctr_remote', *refspecs(existing - fetched)])
+    return existing
+
+# Repack the mirror into a single pack (with a bitmap) when it has more packs
+# than this.
+MIRROR_MAX_PACKS = 20
+
+def get_deploy_mirror(cache_dir, deploy_repo):
+    """
+    Return the path of the bare mirror of ``deploy_repo`` in ``cache_dir``,
+    creating it if it doesn't exist.
+
+    The mirror only has the deploy branch, with its full history. It is meant
+    to be kept between builds (for instance with Travis' cache), so that
+    each build only fetches the new commits (see
+    :func:`update_deploy_mirror`). If the mirror fails an integrity check, it
+    is deleted and created again.
+    """
+    mirror = os.path.join(os.path.abspath(cache_dir),
+        deploy_repo.replace('/', '-') + '.git')
+    if os.path.isdir(mirror):
+        print("Checking the mirror at", mirror)
+        if run(['git', '--git-dir', mirror, 'fsck', '--connectivity-only',
+            '--no-dangling', '--no-progress'], exit=False) == 0:
+            return mirror
+        print(yellow("Warning: the mirror at {} is corrupt. Creating it again.".format(mirror)),
+            file=sys.stderr)
+    create_mirror(mirror)
+    return mirror
+
+def create_mirror(mirror):
+    """
+    Create an empty bare repository at ``mirror``, replacing anything that is
+    already there.
+    """
+    if os.path.exists(mirror):
+        shutil.rmtree(mirror)
+    print("Creating a mirror at", mirror)
+    os.makedirs(mirror)
+    run(['git', 'init', '-q', '--bare', mirror])
+    # Repacking is done by update_deploy_mirror()
+    run(['git', '--git-dir', mirror, 'config', 'gc.auto', '0'])
+
+def update_deploy_mirror(mirror, deploy_branch):
+    """
+    Fetch the new commits of ``deploy_branch`` from ``doctr_remote`` into
+    ``mirror`` and keep its commit-graph and bitmap index up to date.
+
+    If the fetch fails (which can happen when the mirror is corrupt in a way
+    the check in :func:`get_deploy_mirror` didn't catch), the mirror is
+    created again from scratch.
+    """
+    url = subprocess.check_output(['git', 'remote', 'get-url',
+        'doctr_remote']).decode('utf-8').strip()
+    fetch = ['git', '--git-dir', mirror, 'fetch', '--no-tags', url,
+        '+refs/heads/{0}:refs/heads/{0}'.format(deploy_branch)]
+    if run(fetch, exit=False):
+        print(yellow("Warning: could not update the mirror at {}. Creating it again.".format(mirror)),
+            file=sys.stderr)
+        create_mirror(mirror)
+        run(fetch)
+
+    packs = glob.glob(os.path.join(mirror, 'objects', 'pack', '*.pack'))
+    bitmaps = glob.glob(os.path.join(mirror, 'objects', 'pack', '*.bitmap'))
+    if not bitmaps or len(packs) > MIRROR_MAX_PACKS:
+        run(['git', '--git-dir', mirror, 'repack', '-q', '-a', '-d',
+            '--write-bitmap-index'])
+    run(['git', '--git-dir', mirror, 'commit-graph', 'write', '--reachable',
+        '--split'])
+
+def add_alternate(mirror):
+    """
+    Make the objects in ``mirror`` available to the current repository, by
+    adding it to ``objects/info/alternates``.
+    """
+    git_dir = subprocess.check_output(['git', 'rev-parse',
+        '--git-common-dir']).decode('utf-8').strip()
+    alternates = os.path.join(git_dir, 'objects', 'info', 'alternates')
+    objects = os.path.join(mirror, 'objects')
+    if os.path.exists(alternates):
+        with open(alternates) as f:
+            if objects in f.read().splitlines():
+                return
+    print("Using the objects from", mirror)
+    os.makedirs(os.path.dirname(alternates), exist_ok=True)
+    with open(alternates, 'a') as f:
+        f.write(objects + '\n')
+
+# Settings that make git faster on repositories with many files. See
+# https://git-scm.com/docs/git-config#Documentation/git-config.txt-featuremanyFiles
+LARGE_REPO_GIT_CONFIG = [
+    ('feature.manyFiles', 'true'),
+    ('core.untrackedCache', 'true'),
+    ('core.preloadIndex', 'true'),
+]
+
+def configure_git_for_large_repos():
+    """
+    Apply :data:`LARGE_REPO_GIT_CONFIG` to every git command run by doctr
+    (including ``--command``), without changing any git configuration file.
+
+    This uses the ``GIT_CONFIG_COUNT``/``GIT_CONFIG_KEY_<n>``/
+    ``GIT_CONFIG_VALUE_<n>`` environment variables (git 2.31 and newer;
+    older versions ignore them).
+    """
+    count = int(os.environ.get('GIT_CONFIG_COUNT', 0))
+    for key, value in LARGE_REPO_GIT_CONFIG:
+        os.environ['GIT_CONFIG_KEY_%d' % count] = key
+        os.environ['GIT_CONFIG_VALUE_%d' % count] = value
+        count += 1
+    os.environ['GIT_CONFIG_COUNT'] = str(count)
+
 def set_git_user_email():
     """
     Set global user and email for git user if not already present on system
@@ -287,9 +645,48 @@ def set_git_user_email():
     else:
         print("Not setting git user email, as it's already set to %r" % email)
 
-def checkout_deploy_branch(deploy_branch, canpush=True):
+def get_sparse_dir(deploy_dir):
+    """
+    Return the directory to restrict a sparse checkout of the deploy branch
+    to when deploying to ``deploy_dir``, or None if a sparse checkout
+    wouldn't help (``deploy_dir`` is the root) or isn't supported by this
+    version of git (cone mode sparse checkouts need git 2.27).
+    """
+    sparse_dir = os.path.normpath(deploy_dir)
+    if sparse_dir == os.curdir:
+        print("Not using a sparse checkout, since the deploy directory is the root")
+        return None
+    if get_git_version() < (2, 27):
+        print(yellow("Warning: git 2.27 or newer is needed for a sparse checkout. Checking out the whole branch."),
+            file=sys.stderr)
+        return None
+    return sparse_dir
+
+def set_sparse_checkout(sparse_dir, worktree=None):
+    """
+    Restrict the checkout (of ``worktree``, or of the current directory) to
+    ``sparse_dir`` and the top-level files, with a cone mode sparse checkout.
+
+    ``git sparse-checkout set --cone`` needs git 2.35. Older versions need
+    ``git sparse-checkout init --cone`` first.
+    """
+    git = ['git', '-C', worktree] if worktree else ['git']
+    if get_git_version() < (2, 35):
+        run(git + ['sparse-checkout', 'init', '--cone'])
+        run(git + ['sparse-checkout', 'set', sparse_dir])
+    else:
+        run(git + ['sparse-checkout', 'set', '--cone', sparse_dir])
+
+def checkout_deploy_branch(deploy_branch, canpush=True, sparse_dir=None):
     """
     Checkout the deploy branch, creating it if it doesn't exist.
+
+    If ``sparse_dir`` is given (see :func:`get_sparse_dir`), a cone mode
+    sparse checkout is used, so that only ``sparse_dir`` and the files at the
+    top level of the branch (like ``.nojekyll``) are written to disk. The
+    files outside of it stay in the index and are committed unchanged. Run
+    ``git sparse-checkout disable`` after checking out the original commit
+    again.
     """
     # Create an empty branch with .nojekyll if it doesn't already exist
     create_deploy_branch(deploy_branch, push=canpush)
@@ -302,11 +699,73 @@ def checkout_deploy_branch(deploy_branch, canpush=True):
         extra_args = ['--track', remote_branch]
     else:
         extra_args = []
+    if sparse_dir:
+        # Do this before checking out the deploy branch, so that the files
+        # outside of sparse_dir are never written.
+        set_sparse_checkout(sparse_dir)
     run(['git', 'checkout', '-b', DOCTR_WORKING_BRANCH] + extra_args)
     print("Done")
 
     return canpush
 
+def create_nojekyll_commit(deploy_branch):
+    """
+    Create a root commit containing only an empty ``.nojekyll`` file, without
+    touching the working tree or the index, and return its hash.
+    """
+    blob = git_hash_object(b'')
+    tree = subprocess.run(['git', 'mktree'],
+        input='100644 blob {}\t.nojekyll\n'.format(blob).encode('utf-8'),
+        stdout=subprocess.PIPE, check=True).stdout.decode('utf-8').strip()
+    return subprocess.run(['git', 'commit-tree', tree, '-m',
+        'Create new {} branch with .nojekyll'.format(deploy_branch)],
+        stdout=subprocess.PIPE, check=True).stdout.decode('utf-8').strip()
+
+def checkout_deploy_worktree(deploy_branch, sparse_dir=None):
+    """
+    Check out the deploy branch in a new ``git worktree`` in a temporary
+    directory, on the ``DOCTR_WORKING_BRANCH`` branch, and return its path.
+
+    Unlike :func:`checkout_deploy_branch`, this does not touch the current
+    checkout at all, so there is no need to stash it (including all ignored
+    files) first. If the deploy branch doesn't exist, the worktree starts from
+    a new commit with a ``.nojekyll`` file, which is pushed along with the
+    docs.
+
+    If ``sparse_dir`` is given, only it and the top-level files are checked
+    out, like for :func:`checkout_deploy_branch`. The sparse checkout only
+    applies to the worktree.
+
+    Use :func:`remove_deploy_worktree` to remove the worktree afterwards.
+    """
+    remote_branch = "doctr_remote/{}".format(deploy_branch)
+    run(['git', 'worktree', 'prune'])
+    clear_working_branch()
+    if deploy_branch_exists(deploy_branch):
+        start = remote_branch
+    else:
+        print("Creating new {} branch".format(deploy_branch))
+        start = create_nojekyll_commit(deploy_branch)
+    worktree = os.path.join(tempfile.mkdtemp(), 'deploy')
+    print("Checking out", remote_branch, "in a worktree at", worktree)
+    if not sparse_dir:
+        run(['git', 'worktree', 'add', '-B', DOCTR_WORKING_BRANCH, worktree, start])
+        return worktree
+
+    run(['git', 'worktree', 'add', '--no-checkout', '-B', DOCTR_WORKING_BRANCH,
+        worktree, start])
+    set_sparse_checkout(sparse_dir, worktree)
+    run(['git', '-C', worktree, 'reset', '-q', '--hard', 'HEAD'])
+    return worktree
+
+def remove_deploy_worktree(worktree):
+    """
+    Remove the worktree created by :func:`checkout_deploy_worktree`.
+    """
+    run(['git', 'worktree', 'remove', '--force', worktree], exit=False)
+    shutil.rmtree(os.path.dirname(worktree), ignore_errors=True)
+    run(['git', 'worktree', 'prune'], exit=False)
+
 def clear_working_branch():
     local_branch_names = subprocess.check_output(['git', 'branch']).decode('utf-8').split()
     if DOCTR_WORKING_BRANCH in local_branch_names:
@@ -355,7 +814,7 @@ def create_deploy_branch(deploy_branch, push=True):
         run(['git', 'checkout', 'master'])
         run(['git', 'branch', '-D', DOCTR_WORKING_BRANCH])
         # fetch the remote so that doctr_remote/{deploy_branch} is resolved
-        run(['git', 'fetch', 'doctr_remote'])
+        fetch_deploy_branch(deploy_branch)
 
         return True
     return False
@@ -374,11 +833,32 @@ def find_sphinx_build_dir():
 
     return build_folder
 
-# Here is the logic to get the Travis job number, to only run commit_docs in
-# the right build.
-#
-# TRAVIS_JOB_NUMBER = os.environ.get("TRAVIS_JOB_NUMBER", '')
-# ACTUAL_TRAVIS_JOB_NUMBER = TRAVIS_JOB_NUMBER.split('.')[1]
+def get_travis_job_number():
+    """
+    Return the number of the current job in the Travis build, like 2 for
+    ``TRAVIS_JOB_NUMBER=123.2``, or None if we are not on Travis.
+    """
+    TRAVIS_JOB_NUMBER = os.environ.get("TRAVIS_JOB_NUMBER", '')
+    if '.' not in TRAVIS_JOB_NUMBER:
+        return None
+    return int(TRAVIS_JOB_NUMBER.split('.')[1])
+
+def is_deploy_job(deploy_job):
+    """
+    Return whether the current Travis job is the one that deploys, that is,
+    whether its job number (see :func:`get_travis_job_number`) is
+    ``deploy_job``.
+
+    Every job deploys if ``deploy_job`` is None. When not on Travis, there is
+    no build matrix, so this returns True.
+
+    This only looks at the environment, so the jobs that don't deploy can
+    stop before doing any network or git operations.
+    """
+    if deploy_job is None:
+        return True
+    job_number = get_travis_job_number()
+    return job_number is None or job_number == deploy_job
 
 def copy_to_tmp(source):
     """
@@ -407,84 +887,1057 @@ def is_subdir(a, b):
 
     return os.path.commonpath([a, b]) == b
 
-def sync_from_log(src, dst, log_file, exclude=()):
+def git_blob_hash(path):
+    """
+    Return the hash git would give the contents of the file ``path`` as a
+    blob (the same as ``git hash-object path``, without any filters applied).
+    """
+    h = hashlib.sha1(b'blob %d\0' % os.stat(path).st_size)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def get_index_blob_hashes(path):
+    """
+    Return a dictionary mapping every file under ``path`` in the git index to
+    its blob hash.
+
+    The keys are normalized paths relative to the current directory.
+    """
+    out = subprocess.check_output(['git', 'ls-files', '-s', '-z', '--', path])
+    hashes = {}
+    for entry in out.decode('utf-8').split('\0'):
+        if not entry:
+            continue
+        info, name = entry.split('\t', 1)
+        hashes[os.path.normpath(name)] = info.split()[1]
+    return hashes
+
+def is_glob(pattern):
+    """
+    Return True if ``pattern`` contains glob characters (``*``, ``?`` or ``[``).
+    """
+    return any(c in pattern for c in '*?[')
+
+def _glob_to_regex(pattern):
+    """
+    Translate a gitignore-style glob into a regular expression.
+
+    ``*`` and ``?`` do not match ``/``, ``**`` matches anything (including
+    ``/``), and ``[...]`` is a character class.
+    """
+    i, n = 0, len(pattern)
+    res = []
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            res.append('(?:.*/)?')
+            i += 3
+            continue
+        elif pattern.startswith('**', i):
+            res.append('.*')
+            i += 2
+            continue
+        elif c == '*':
+            res.append('[^/]*')
+        elif c == '?':
+            res.append('[^/]')
+        elif c == '[':
+            j = pattern.find(']', i + 2)
+            if j == -1:
+                res.append(re.escape(c))
+            else:
+                stuff = pattern[i + 1:j]
+                if stuff.startswith('!'):
+                    stuff = '^' + stuff[1:]
+                res.append('[' + stuff.replace('\\', '\\\\') + ']')
+                i = j
+        else:
+            res.append(re.escape(c))
+        i += 1
+    return ''.join(res)
+
+def compile_exclude(exclude):
+    """
+    Compile the list of exclude patterns ``exclude`` into a function
+    ``excluded(path)`` that returns True if ``path`` (relative to the root
+    the patterns are relative to) is excluded.
+
+    Plain paths exclude that file or directory and everything under it. They
+    are stored in a trie of path components, so checking a path costs one
+    dictionary lookup per component no matter how many paths are excluded.
+
+    Patterns containing ``*``, ``?`` or ``[`` are matched gitignore-style: a
+    pattern without a ``/`` matches the name of a file or directory at any
+    depth, and a pattern with a ``/`` is matched against the whole path. ``**``
+    matches any number of directories. A pattern that matches a directory
+    excludes everything under it.
+    """
+    trie = {}
+    name_globs, path_globs = [], []
+    for pattern in exclude:
+        pattern = pattern.replace(os.sep, '/')
+        if is_glob(pattern):
+            pattern = pattern.rstrip('/')
+            if '/' in pattern:
+                path_globs.append(_glob_to_regex(pattern.lstrip('/')))
+            else:
+                name_globs.append(_glob_to_regex(pattern))
+            continue
+        parts = [i for i in os.path.normpath(pattern).replace(os.sep, '/').split('/')
+                 if i not in ('', '.')]
+        if not parts:
+            # Everything is excluded
+            return lambda path: True
+        node = trie
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if node is True:
+                break
+        else:
+            node[parts[-1]] = True
+
+    name_re = re.compile('(?:%s)\\Z' % '|'.join(name_globs)) if name_globs else None
+    path_re = re.compile('(?:%s)\\Z' % '|'.join(path_globs)) if path_globs else None
+
+    def excluded(path):
+        parts = [i for i in path.replace(os.sep, '/').split('/') if i not in ('', '.')]
+        node = trie
+        for part in parts:
+            node = node.get(part)
+            if node is True:
+                return True
+            if node is None:
+                break
+        if name_re and any(name_re.match(part) for part in parts):
+            return True
+        if path_re and any(path_re.match('/'.join(parts[:i])) for i in
+                           range(1, len(parts) + 1)):
+            return True
+        return False
+
+    return excluded
+
+def walk_built_docs(src, exclude=()):
+    """
+    Return a sorted list of the files and directories in ``src``, relative to
+    ``src``. Directories end with ``os.sep``.
+
+    Hidden files and directories are skipped, and ``exclude`` is a list of
+    patterns relative to ``src`` (see :func:`compile_exclude`). Excluded
+    directories are pruned during the walk, so nothing under them is listed.
+
+    If ``src`` is a file, the list contains just its name.
+    """
+    excluded = compile_exclude(exclude)
+
+    if not os.path.isdir(src):
+        name = os.path.basename(src)
+        return [] if excluded(name) else [name]
+
+    paths = []
+    for root, dirs, files in os.walk(src, followlinks=True):
+        rel = os.path.relpath(root, src)
+        prefix = '' if rel == os.curdir else rel + os.sep
+        keep = []
+        for d in dirs:
+            if d.startswith('.') or excluded(prefix + d):
+                continue
+            keep.append(d)
+            paths.append(prefix + d + os.sep)
+        dirs[:] = keep
+        for f in files:
+            if f.startswith('.') or excluded(prefix + f):
+                continue
+            paths.append(prefix + f)
+    # sorted makes this easier to test
+    paths.sort()
+    return paths
+
+def map_jobs(func, items, jobs=1):
+    """
+    Yield ``func(i)`` for each ``i`` in ``items``, running up to ``jobs``
+    calls at once in a thread pool if ``jobs`` is greater than 1.
+
+    The results are always yielded in the same order as ``items``, as soon as
+    they are available.
+    """
+    if jobs > 1 and len(items) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+            yield from executor.map(func, items)
+    else:
+        for i in items:
+            yield func(i)
+
+def _no_callback(event, info):
+    pass
+
+class ProgressPrinter:
+    """
+    A ``callback`` for :func:`sync_from_log` and :func:`commit_docs` that
+    prints a progress line with the throughput at most every ``interval``
+    seconds, as well as a line when each phase finishes. Phases without any
+    ``file_*`` events (like ``'stage'`` and ``'commit'``) only print how long
+    they took.
+
+    This keeps long deploys from being killed by Travis for not producing
+    any output.
+    """
+    def __init__(self, interval=10, file=sys.stdout):
+        self.interval = interval
+        self.file = file
+        self.phase = None
+
+    def _line(self, now):
+        elapsed = max(now - self.phase_start, 1e-9)
+        if not self.files:
+            return "%s: %.1f s" % (self.phase, elapsed)
+        return "%s: %s files (%.1f files/s), %.1f MB (%.1f MB/s), %.1f s" % (
+            self.phase, format(self.files, ','), self.files/elapsed,
+            self.bytes/1e6, self.bytes/1e6/elapsed, elapsed)
+
+    def __call__(self, event, info):
+        now = time.monotonic()
+        if event == 'phase_started':
+            self.phase = info['phase']
+            self.phase_start = self.last_print = now
+            self.files = self.bytes = 0
+        elif event == 'phase_finished':
+            print(self._line(now), file=self.file)
+            self.file.flush()
+        elif event.startswith('file_'):
+            self.files += 1
+            self.bytes = info['bytes_so_far']
+            if self.interval and now - self.last_print >= self.interval:
+                print(self._line(now), file=self.file)
+                self.file.flush()
+                self.last_print = now
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+COPY_MODES = ['auto', 'reflink', 'hardlink', 'copy']
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    shutil.copymode(src, dst)
+
+def _copy_file_range(src, dst):
+    with open(src, 'rb') as s, open(dst, 'wb') as d:
+        while os.copy_file_range(s.fileno(), d.fileno(), 1 << 30):
+            pass
+    shutil.copymode(src, dst)
+
+def _hardlink(src, dst):
+    if os.stat(src).st_dev != os.stat(os.path.dirname(os.path.abspath(dst))).st_dev:
+        raise OSError("%s and %s are on different filesystems" % (src, dst))
+    os.link(src, dst)
+
+def make_copier(copy_mode='copy'):
+    """
+    Return a function ``copy(src, dst)`` that copies the file ``src`` to
+    ``dst`` using ``copy_mode``, which should be one of :data:`COPY_MODES`.
+
+    - ``'copy'`` uses ``shutil.copy2``, which reads and writes every byte and
+      copies the timestamps and permissions.
+    - ``'reflink'`` makes a copy-on-write clone of the file (FICLONE, which
+      works on btrfs and xfs).
+    - ``'hardlink'`` hard links ``dst`` to ``src`` when they are on the same
+      filesystem. Note that modifying one of the files in place modifies the
+      other.
+    - ``'auto'`` tries a reflink, then ``os.copy_file_range`` (which copies
+      inside the kernel), then a hard link.
+
+    If the requested strategy is not supported, the file is copied normally.
+    A strategy that fails once is not tried again by the same copier.
+    """
+    if copy_mode not in COPY_MODES:
+        raise ValueError("copy_mode must be one of %s" % ', '.join(COPY_MODES))
+    if copy_mode == 'copy':
+        return shutil.copy2
+
+    strategies = {
+        'auto': [_reflink, _copy_file_range, _hardlink],
+        'reflink': [_reflink],
+        'hardlink': [_hardlink],
+    }[copy_mode]
+    if not hasattr(os, 'copy_file_range'):
+        strategies = [i for i in strategies if i is not _copy_file_range]
+    failed = set()
+
+    def copy(src, dst):
+        if os.path.lexists(dst):
+            # Never write into an existing file, which may itself be a hard
+            # link.
+            os.unlink(dst)
+        for strategy in strategies:
+            if strategy in failed:
+                continue
+            try:
+                strategy(src, dst)
+                return
+            except (OSError, ImportError) as e:
+                # A failed strategy may have created dst already. That
+                # shouldn't disable the next strategy.
+                if os.path.lexists(dst):
+                    os.unlink(dst)
+                if not isinstance(e, FileExistsError):
+                    failed.add(strategy)
+        shutil.copy(src, dst)
+
+    return copy
+
+MANIFEST_HEADER = '# doctr-files v'
+
+def parse_manifest(text):
+    """
+    Parse the contents of a ``.doctr-files`` manifest.
+
+    Returns ``(version, entries)``, where ``entries`` is a list of ``(path,
+    size, hash)`` tuples sorted by path.
+
+    Version 1 manifests are a plain newline separated list of paths, so
+    ``size`` and ``hash`` are None for them. Version 2 manifests start with a
+    ``# doctr-files v2`` header, and every line after it is the size, the git
+    blob hash and the path of a file, separated by tabs. Other lines starting
+    with ``#`` are ignored (see :func:`parse_manifest_metadata`).
+    """
+    lines = text.split('\n')
+    if not lines[0].startswith(MANIFEST_HEADER):
+        entries = [(i.strip(), None, None) for i in lines if i.strip()]
+        return 1, sorted(entries)
+
+    version = int(lines[0][len(MANIFEST_HEADER):])
+    if version != 2:
+        raise RuntimeError("Unsupported .doctr-files version %s. You may need to upgrade doctr." % version)
+    entries = []
+    for line in lines[1:]:
+        if not line or line.startswith('#'):
+            continue
+        size, hash, path = line.split('\t', 2)
+        entries.append((path, int(size), hash))
+    return version, sorted(entries)
+
+def parse_manifest_metadata(text):
+    """
+    Return the metadata in the contents of a ``.doctr-files`` manifest (see
+    :func:`get_deploy_metadata`) as a dict.
+
+    The metadata are ``# key: value`` lines after the header of a version 2
+    manifest. Version 1 manifests have no metadata.
+    """
+    lines = text.split('\n')
+    metadata = {}
+    if not lines[0].startswith(MANIFEST_HEADER):
+        return metadata
+    for line in lines[1:]:
+        if not line.startswith('# '):
+            continue
+        key, sep, value = line[2:].partition(': ')
+        if sep:
+            metadata[key] = value
+    return metadata
+
+def get_deploy_metadata():
+    """
+    Return the metadata about the current deploy that is written to the
+    ``.doctr-files`` manifest, as a list of ``(key, value)`` pairs.
+
+    These are used by ``doctr gc`` (see :func:`find_deploy_dirs`):
+
+    - ``changed``: the time of the deploy, in seconds since the epoch.
+    - ``branch``: the branch that was built (not set for tag builds).
+    - ``tag``: the tag that was built, for tag builds.
+    - ``commit``: the commit that was built.
+
+    A deploy that doesn't change any file keeps the previous manifest, so
+    these describe the last deploy that changed the deploy directory.
+    """
+    metadata = [('changed', str(int(time.time())))]
+    TRAVIS_TAG = os.environ.get("TRAVIS_TAG", "")
+    if TRAVIS_TAG:
+        metadata.append(('tag', TRAVIS_TAG))
+    elif get_travis_branch():
+        metadata.append(('branch', get_travis_branch()))
+    if os.environ.get("TRAVIS_COMMIT"):
+        metadata.append(('commit', os.environ["TRAVIS_COMMIT"]))
+    return metadata
+
+def read_manifest(log_file):
+    """
+    Read the ``.doctr-files`` manifest ``log_file``.
+
+    See :func:`parse_manifest`.
+    """
+    with open(log_file) as f:
+        return parse_manifest(f.read())
+
+def format_manifest(entries, version=2, metadata=()):
+    """
+    Return the contents of a ``.doctr-files`` manifest listing the ``(path,
+    size, hash)`` tuples ``entries``.
+
+    ``metadata`` is a list of ``(key, value)`` pairs (see
+    :func:`get_deploy_metadata`). It is ignored for version 1 manifests.
+
+    See :func:`parse_manifest` for the format.
+    """
+    if version == 1:
+        return '\n'.join(path for path, size, hash in entries)
+    return (MANIFEST_HEADER + str(version) + '\n' +
+        ''.join('# %s: %s\n' % (key, value) for key, value in metadata) +
+        ''.join('%s\t%s\t%s\n' % (size, hash, path) for path, size, hash in
+        sorted(entries)))
+
+def write_manifest(log_file, entries, version=2, metadata=()):
+    """
+    Write the ``(path, size, hash)`` tuples ``entries`` to the ``.doctr-files``
+    manifest ``log_file``.
+
+    See :func:`format_manifest`.
+    """
+    with open(log_file, 'w') as f:
+        f.write(format_manifest(entries, version=version, metadata=metadata))
+
+# Extensions of files that are already compressed, so delta compressing them
+# when packing wastes CPU time without making the pack smaller
+BINARY_EXTENSIONS = {
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.ico', '.svgz',
+    '.woff', '.woff2', '.ttf', '.otf', '.eot',
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.whl', '.pdf', '.epub',
+    '.mp3', '.mp4', '.webm', '.ogg',
+}
+
+GITATTRIBUTES_BEGIN = "# Begin doctr: already compressed files are not delta compressed"
+GITATTRIBUTES_END = "# End doctr"
+
+def get_binary_patterns(paths):
+    """
+    Return the sorted ``.gitattributes`` patterns (like ``'*.png'``) for the
+    extensions in :data:`BINARY_EXTENSIONS` that appear in ``paths``.
+    """
+    extensions = {os.path.splitext(path)[1].lower() for path in paths}
+    return sorted('*' + ext for ext in extensions & BINARY_EXTENSIONS)
+
+def update_gitattributes(text, patterns):
+    """
+    Return the ``.gitattributes`` contents ``text`` with ``patterns`` marked
+    ``-delta`` in the block that doctr maintains.
+
+    The patterns already in the block are kept (they may come from other
+    deploy directories), and everything outside of the block is left alone.
+    If there are no patterns at all, ``text`` is returned unchanged, so no
+    empty block is added.
+    """
+    lines = text.splitlines()
+    if GITATTRIBUTES_BEGIN in lines and GITATTRIBUTES_END in lines:
+        begin = lines.index(GITATTRIBUTES_BEGIN)
+        end = lines.index(GITATTRIBUTES_END, begin)
+        old = {line.split()[0] for line in lines[begin+1:end] if line.strip()}
+        before, after = lines[:begin], lines[end+1:]
+    else:
+        old = set()
+        before, after = lines, []
+    patterns = old | set(patterns)
+    if not patterns:
+        return text
+    block = [GITATTRIBUTES_BEGIN]
+    block += ['%s -delta' % pattern for pattern in sorted(patterns)]
+    block.append(GITATTRIBUTES_END)
+    return ''.join(line + '\n' for line in before + block + after)
+
+def write_gitattributes(path, patterns):
+    """
+    Update the ``.gitattributes`` file ``path`` with :func:`update_gitattributes`.
+
+    Returns True if the file changed.
+    """
+    text = ''
+    if os.path.exists(path):
+        with open(path) as f:
+            text = f.read()
+    new_text = update_gitattributes(text, patterns)
+    if new_text == text:
+        return False
+    with open(path, 'w') as f:
+        f.write(new_text)
+    return True
+
+def sync_from_log(src, dst, log_file, exclude=(), *, skip_unchanged=False,
+    jobs=1, copy_mode='copy', manifest_version=1, metadata=(), callback=None):
     """
     Sync the files in ``src`` to ``dst``.
 
     The files that are synced are logged to ``log_file``. If ``log_file``
-    exists, the files in ``log_file`` are removed first.
+    exists, the files in ``log_file`` that are not in ``src`` are removed.
 
     Returns ``(added, removed)``, where added is a list of all files synced from
     ``src`` (even if it already existed in ``dst``), and ``removed`` is every
     file from ``log_file`` that was removed from ``dst`` because it wasn't in
     ``src``. ``added`` also includes the log file.
 
-    ``exclude`` may be a list of paths from ``src`` that should be ignored.
-    Such paths are neither added nor removed, even if they are in the logfile.
+    When writing a version 2 log file, files in ``dst`` whose blob in the git
+    index is the same as the file in ``src`` are not copied again. They are
+    still included in ``added``.
+
+    ``exclude`` may be a list of paths or glob patterns from ``src`` that
+    should be ignored (see :func:`compile_exclude`). Such paths are neither
+    added nor removed, even if they are in the logfile.
+
+    If ``skip_unchanged`` is True, files in ``dst`` whose contents are
+    byte-identical (compared by git blob hash) to the file in ``src`` are not
+    copied. In that case ``(added, removed, unchanged)`` is returned, where
+    ``added`` only contains the files that were actually copied and
+    ``unchanged`` contains the ones that were skipped. The hash of the file in
+    ``dst`` is taken from the blob in the git index, like above. Outside of a
+    git repository, it is taken from the log file if it is a version 2
+    manifest (as long as the size of the file in ``dst`` still matches it).
+
+    The git index is preferred to the log file, since the log file may not
+    match the committed files (for instance if ``--command`` changed them, or
+    if a commit was replayed on top of another deploy, see
+    :func:`replay_commit`).
+
+    ``jobs`` is the number of files to copy or remove at once. The returned
+    lists are in the same (sorted) order regardless of ``jobs``.
+
+    ``copy_mode`` is how files are transferred (see :func:`make_copier`).
+
+    ``manifest_version`` is the version of the log file to write (see
+    :func:`parse_manifest`). A log file is never downgraded, so a version 1
+    log file is upgraded to version 2 automatically, but not the other way
+    around. ``metadata`` is written to version 2 log files (see
+    :func:`format_manifest`).
+
+    ``callback``, if given, is called as ``callback(event, info)`` as the sync
+    progresses, where ``event`` is one of
+
+    - ``'phase_started'`` and ``'phase_finished'``, with ``info['phase']``
+      set to ``'remove'`` or ``'sync'``,
+    - ``'file_removed'``, ``'file_copied'`` and ``'file_unchanged'``, with
+      ``info['path']`` set to the path in ``dst``, ``info['bytes']`` to its
+      size and ``info['bytes_so_far']`` to the total size of the files
+      processed so far in the phase.
+
+    :class:`ProgressPrinter` is a ``callback`` that prints the progress.
     """
-    from os.path import join, exists, isdir
+    from os.path import join, exists
 
-    exclude = [os.path.normpath(i) for i in exclude]
+    excluded = compile_exclude(exclude)
 
-    added, removed = [], []
+    added, removed, unchanged, logged = [], [], [], []
+
+    if os.path.isdir(src):
+        src_root = src
+    else:
+        src_root = os.path.dirname(src)
+    os.makedirs(dst, exist_ok=True)
+
+    new_files = []
+    for f in walk_built_docs(src, exclude):
+        if f.endswith(os.sep):
+            os.makedirs(join(dst, f), exist_ok=True)
+        else:
+            new_files.append((join(src_root, f), join(dst, f)))
 
     if not exists(log_file):
         # Assume this is the first run
         print("%s doesn't exist. Not removing any files." % log_file)
+        old_version, old_entries = 1, []
     else:
-        with open(log_file) as f:
-            files = f.read().strip().split('\n')
-
-        for new_f in files:
-            new_f = new_f.strip()
-            if any(is_subdir(new_f, os.path.join(dst, i)) for i in exclude):
-                pass
-            elif exists(new_f):
-                os.remove(new_f)
-                removed.append(new_f)
+        old_version, old_entries = read_manifest(log_file)
+    version = max(manifest_version, old_version)
+
+    # Both lists are sorted by path, so a single merge-join pass finds the
+    # files that were removed, and pairs up the ones that are in both with
+    # their old manifest entry.
+    dst_prefix = join(dst, '')
+    to_remove, to_sync = [], []
+    i = j = 0
+    while i < len(old_entries) or j < len(new_files):
+        if j == len(new_files) or (i < len(old_entries) and
+                                   old_entries[i][0] < new_files[j][1]):
+            old_f = old_entries[i][0]
+            if old_f.startswith(dst_prefix):
+                rel = old_f[len(dst_prefix):]
             else:
-                print("Warning: File %s doesn't exist." % new_f, file=sys.stderr)
+                rel = os.path.relpath(old_f, dst)
+            if not excluded(rel):
+                to_remove.append(old_f)
+            i += 1
+        elif i == len(old_entries) or new_files[j][1] < old_entries[i][0]:
+            to_sync.append(new_files[j] + (None,))
+            j += 1
+        else:
+            to_sync.append(new_files[j] + (old_entries[i],))
+            i += 1
+            j += 1
+
+    def remove_file(old_f):
+        try:
+            os.remove(old_f)
+        except FileNotFoundError:
+            print("Warning: File %s doesn't exist." % old_f, file=sys.stderr)
+            return False
+        return True
 
-    if os.path.isdir(src):
-        if not src.endswith(os.sep):
-            src += os.sep
-        files = glob.iglob(join(src, '**'), recursive=True)
+    callback = callback or _no_callback
+    callback('phase_started', {'phase': 'remove'})
+    for old_f, was_removed in zip(to_remove, map_jobs(remove_file, to_remove, jobs)):
+        if was_removed:
+            removed.append(old_f)
+            callback('file_removed', {'path': old_f, 'bytes': 0, 'bytes_so_far': 0})
+    callback('phase_finished', {'phase': 'remove'})
+
+    if ((skip_unchanged or version >= 2) and any(exists(new_f) for f, new_f,
+        old in to_sync) and subprocess.run(['git', 'rev-parse',
+        '--is-inside-work-tree'], stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL).returncode == 0):
+        index_hashes = get_index_blob_hashes(dst)
     else:
-        files = [src]
-        src = os.path.dirname(src) + os.sep if os.sep in src else ''
+        index_hashes = None
+    copy = make_copier(copy_mode)
+
+    def sync_file(item):
+        f, new_f, old = item
+        size = os.stat(f).st_size
+        hash = git_blob_hash(f) if skip_unchanged or version >= 2 else None
+        if hash is not None and exists(new_f):
+            if index_hashes is not None:
+                known_hash = index_hashes.get(os.path.normpath(new_f))
+            elif old is not None and old[2] is not None:
+                known_hash = old[2] if os.stat(new_f).st_size == old[1] else None
+            else:
+                known_hash = None
+            if known_hash == hash:
+                return False, size, hash
+        copy(f, new_f)
+        return True, size, hash
+
+    callback('phase_started', {'phase': 'sync'})
+    bytes_so_far = 0
+    for (f, new_f, old), (copied, size, hash) in zip(to_sync,
+        map_jobs(sync_file, to_sync, jobs)):
+        bytes_so_far += size
+        info = {'path': new_f, 'bytes': size, 'bytes_so_far': bytes_so_far}
+        if copied or not skip_unchanged:
+            added.append(new_f)
+        if copied:
+            callback('file_copied', info)
+        else:
+            unchanged.append(new_f)
+            callback('file_unchanged', info)
+        logged.append((new_f, size, hash))
+    callback('phase_finished', {'phase': 'sync'})
 
-        os.makedirs(dst, exist_ok=True)
+    # Keep the old log file (and its metadata) if nothing changed, so that
+    # deploying the same docs again doesn't make a new commit.
+    if version != old_version or sorted(logged) != old_entries:
+        write_manifest(log_file, logged, version=version, metadata=metadata)
 
-    # sorted makes this easier to test
-    for f in sorted(files):
-        if any(is_subdir(f, os.path.join(src, i)) for i in exclude):
+    added.append(log_file)
+
+    if skip_unchanged:
+        return added, removed, unchanged
+    return added, removed
+
+def get_tree_files(ref, path='.', sizes=False):
+    """
+    Return a dictionary mapping every file under ``path`` in the tree of the
+    git ref ``ref`` to its ``(blob hash, size)``.
+
+    The size is None unless ``sizes`` is True. Getting the sizes requires
+    the blobs themselves, which a ``blob:none`` fetch (see
+    :func:`fetch_deploy_branch`) does not download, so avoid it when
+    possible.
+
+    The keys are normalized paths relative to the root of the tree. If
+    ``ref`` does not exist, an empty dictionary is returned.
+    """
+    if subprocess.run(['git', 'rev-parse', '--verify', '--quiet', ref + '^{tree}'],
+                      stdout=subprocess.DEVNULL).returncode:
+        return {}
+    out = subprocess.check_output(['git', 'ls-tree', '-r', '-z',
+        *(['-l'] if sizes else []), ref, '--', os.path.normpath(path)])
+    files = {}
+    for entry in out.decode('utf-8').split('\0'):
+        if not entry:
             continue
-        new_f = join(dst, f[len(src):])
+        info, name = entry.split('\t', 1)
+        info = info.split()
+        if info[1] == 'blob':
+            files[name] = (info[2], int(info[3]) if sizes else None)
+    return files
 
-        if isdir(f) or f.endswith(os.sep):
-            os.makedirs(new_f, exist_ok=True)
+def get_blob_sizes(hashes):
+    """
+    Return the sizes of the git blobs ``hashes``, using a single ``git
+    cat-file --batch-check`` process.
+    """
+    if not hashes:
+        return []
+    out = subprocess.run(['git', 'cat-file', '--batch-check=%(objectsize)'],
+        input=''.join(i + '\n' for i in hashes).encode('utf-8'),
+        stdout=subprocess.PIPE, check=True).stdout.decode('utf-8')
+    return [int(i) for i in out.split()]
+
+def fetch_missing_blobs(ref, hashes):
+    """
+    Download the blobs ``hashes`` from the tree of the git ref ``ref`` that
+    were left out by a ``blob:none`` fetch (see :func:`fetch_deploy_branch`),
+    with a single fetch from ``doctr_remote``.
+
+    Otherwise, git fetches a missing blob from the remote by itself as soon
+    as anything reads it (even just its size), one round trip per blob.
+    """
+    if not hashes or subprocess.run(['git', 'config', '--get',
+        'remote.doctr_remote.promisor'], stdout=subprocess.DEVNULL).returncode:
+        return
+    out = subprocess.check_output(['git', 'rev-list', '--objects', '--no-walk',
+        '--missing=print', ref]).decode('utf-8')
+    missing = {line[1:] for line in out.split() if line.startswith('?')}
+    missing = sorted(missing.intersection(hashes))
+    if not missing:
+        return
+    run(['git', '-c', 'fetch.negotiationAlgorithm=noop', 'fetch', '--no-tags',
+        '--no-write-fetch-head', '--filter=blob:none', '--stdin',
+        'doctr_remote'], input=''.join(i + '\n' for i in missing).encode('utf-8'),
+        summary='%s blobs' % format(len(missing), ','))
+
+def get_ref_manifest(ref, log_file):
+    """
+    Return the ``(version, entries)`` of the ``.doctr-files`` manifest
+    ``log_file`` in the git ref ``ref``, without checking it out (see
+    :func:`parse_manifest`). The paths in ``entries`` are normalized.
+
+    Returns ``(1, [])`` if the manifest or the ref do not exist.
+    """
+    p = subprocess.run(['git', 'show', '%s:%s' % (ref, os.path.normpath(log_file))],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if p.returncode:
+        return 1, []
+    version, entries = parse_manifest(p.stdout.decode('utf-8'))
+    return version, sorted((os.path.normpath(path), size, hash) for path, size,
+        hash in entries)
+
+def plan_deploy(src, deploy_dir, ref, exclude=(), jobs=1):
+    """
+    Compute what deploying the built docs in ``src`` to ``deploy_dir`` on the
+    git ref ``ref`` (like ``'doctr_remote/gh-pages'``) would change, without
+    checking anything out, copying or committing.
+
+    The files in ``src`` are compared by git blob hash to the tree of ``ref``,
+    and the files that would be removed are taken from the ``.doctr-files``
+    manifest in ``deploy_dir`` on ``ref``. ``exclude`` and ``jobs`` are the
+    same as for :func:`sync_from_log`.
+
+    Returns a dictionary with the sorted lists of paths that would be
+    ``'added'``, ``'modified'`` and ``'removed'``, the number of
+    ``'unchanged'`` files, and a ``'bytes'`` dictionary with the total size of
+    the added, modified and removed files (the size of the new version for
+    modified files, and of the old version for removed ones).
+    """
+    from os.path import join, normpath
+
+    excluded = compile_exclude(exclude)
+    log_file = join(deploy_dir, '.doctr-files')
+    tree = get_tree_files(ref, deploy_dir)
+    version, old_entries = get_ref_manifest(ref, log_file)
+
+    src_root = src if os.path.isdir(src) else os.path.dirname(src)
+    new_files = [f for f in walk_built_docs(src, exclude) if not f.endswith(os.sep)]
+    new_paths = [normpath(join(deploy_dir, f)) for f in new_files]
+
+    def hash_file(f):
+        path = join(src_root, f)
+        return git_blob_hash(path), os.stat(path).st_size
+
+    plan = {
+        'ref': ref,
+        'deploy_directory': deploy_dir,
+        'added': [],
+        'modified': [],
+        'removed': [],
+        'unchanged': 0,
+        'bytes': {'added': 0, 'modified': 0, 'removed': 0},
+    }
+    for path, (hash, size) in zip(new_paths, map_jobs(hash_file, new_files, jobs)):
+        if path not in tree:
+            plan['added'].append(path)
+            plan['bytes']['added'] += size
+        elif tree[path][0] != hash:
+            plan['modified'].append(path)
+            plan['bytes']['modified'] += size
         else:
-            shutil.copy2(f, new_f)
-            added.append(new_f)
-            if new_f in removed:
-                removed.remove(new_f)
+            plan['unchanged'] += 1
 
-    with open(log_file, 'w') as f:
-        f.write('\n'.join(added))
+    new_paths = set(new_paths)
+    unknown_sizes = []
+    for path, size, hash in old_entries:
+        if path in new_paths or path not in tree:
+            continue
+        if excluded(os.path.relpath(path, deploy_dir)):
+            continue
+        plan['removed'].append(path)
+        if size is not None and hash == tree[path][0]:
+            plan['bytes']['removed'] += size
+        else:
+            unknown_sizes.append(tree[path][0])
+    # Only look at the blobs when the manifest doesn't have the size
+    fetch_missing_blobs(ref, unknown_sizes)
+    plan['bytes']['removed'] += sum(get_blob_sizes(unknown_sizes))
 
-    added.append(log_file)
+    return plan
 
-    return added, removed
+def format_plan(plan):
+    """
+    Format the result of :func:`plan_deploy` as a human readable summary.
+    """
+    lines = ["Deploy plan for %s in %s:" % (plan['deploy_directory'], plan['ref'])]
+    for kind in ['added', 'modified', 'removed']:
+        lines.append("  %-9s %s files, %.1f MB" % (kind + ':',
+            format(len(plan[kind]), ','), plan['bytes'][kind]/1e6))
+    lines.append("  %-9s %s files" % ('unchanged:', format(plan['unchanged'], ',')))
+    for kind, symbol in [('added', 'A'), ('modified', 'M'), ('removed', 'D')]:
+        for path in plan[kind]:
+            lines.append("%s %s" % (symbol, path))
+    return '\n'.join(lines)
+
+def get_deploy_files(ref, deploy_dir):
+    """
+    Return a dictionary mapping every file deployed to ``deploy_dir`` in the
+    git ref ``ref`` to its ``(blob hash, size)``.
+
+    The files are the ones in the ``.doctr-files`` manifest in
+    ``deploy_dir``, or every file under ``deploy_dir`` if there is no
+    manifest. The sizes are taken from the manifest when it has them, so the
+    blobs are only looked at (and downloaded, see
+    :func:`fetch_missing_blobs`) for version 1 manifests.
+    """
+    tree = get_tree_files(ref, deploy_dir)
+    version, entries = get_ref_manifest(ref, os.path.join(deploy_dir, '.doctr-files'))
+    if entries:
+        paths = [path for path, size, hash in entries if path in tree]
+    else:
+        paths = sorted(tree)
+    sizes = {path: size for path, size, hash in entries if size is not None
+        and path in tree and tree[path][0] == hash}
+    unknown = [path for path in paths if path not in sizes]
+    unknown_hashes = [tree[path][0] for path in unknown]
+    fetch_missing_blobs(ref, unknown_hashes)
+    sizes.update(zip(unknown, get_blob_sizes(unknown_hashes)))
+    return {path: (tree[path][0], sizes[path]) for path in paths}
+
+def analyze_deploy(ref, deploy_dir, previous=None, largest=10):
+    """
+    Compute statistics about the docs deployed to ``deploy_dir`` in the git
+    ref ``ref``, compared to the git ref ``previous`` (the previous deploy,
+    or None if there isn't one).
+
+    Returns a dictionary with the number of ``'files'``, their total
+    ``'bytes'``, the ``'previous_bytes'`` and the ``'growth'`` (the
+    difference between the two), the ``'added_bytes'`` of the files that are
+    new or modified, the ``largest`` largest files (as a list of ``{'path':
+    ..., 'bytes': ...}``), and the number of files and bytes for each file
+    extension in ``'extensions'``.
+
+    See :func:`get_deploy_files`.
+    """
+    files = get_deploy_files(ref, deploy_dir)
+    old_files = get_deploy_files(previous, deploy_dir) if previous else {}
+
+    total = sum(size for hash, size in files.values())
+    previous_bytes = sum(size for hash, size in old_files.values())
+    extensions = {}
+    for path, (hash, size) in files.items():
+        ext = os.path.splitext(path)[1].lower()
+        stats = extensions.setdefault(ext, {'files': 0, 'bytes': 0})
+        stats['files'] += 1
+        stats['bytes'] += size
+    largest_files = sorted(files.items(), key=lambda i: (-i[1][1], i[0]))[:largest]
+
+    return {
+        'ref': ref,
+        'deploy_directory': deploy_dir,
+        'files': len(files),
+        'bytes': total,
+        'previous_bytes': previous_bytes,
+        'growth': total - previous_bytes,
+        'added_bytes': sum(size for path, (hash, size) in files.items() if
+            old_files.get(path, (None,))[0] != hash),
+        'largest': [{'path': path, 'bytes': size} for path, (hash, size) in
+            largest_files],
+        'extensions': dict(sorted(extensions.items())),
+    }
+
+def format_deploy_stats(stats):
+    """
+    Format the result of :func:`analyze_deploy` as a human readable summary.
+    """
+    lines = ["Deploy statistics for %s in %s:" % (stats['deploy_directory'], stats['ref']),
+        "  %s files, %.1f MB (%+.1f MB since the previous deploy, %.1f MB new or modified)" % (
+            format(stats['files'], ','), stats['bytes']/1e6,
+            stats['growth']/1e6, stats['added_bytes']/1e6),
+        "  Largest files:"]
+    for f in stats['largest']:
+        lines.append("    %10.1f KB %s" % (f['bytes']/1e3, f['path']))
+    lines.append("  Files by extension:")
+    for ext, ext_stats in sorted(stats['extensions'].items(),
+        key=lambda i: -i[1]['bytes']):
+        lines.append("    %-10s %s files, %.1f MB" % (ext or '(none)',
+            format(ext_stats['files'], ','), ext_stats['bytes']/1e6))
+    return '\n'.join(lines)
+
+def check_deploy_budgets(stats, *, max_deploy_size=None, max_growth=None):
+    """
+    Check the result of :func:`analyze_deploy` against the size budgets.
 
-def commit_docs(*, added, removed):
+    Returns a list of messages describing the budgets that are exceeded.
     """
-    Commit the docs to the current branch
+    errors = []
+    if max_deploy_size is not None and stats['bytes'] > max_deploy_size:
+        errors.append("The deploy of %s is %s bytes, more than --max-deploy-size (%s bytes)" %
+            (stats['deploy_directory'], stats['bytes'], max_deploy_size))
+    if max_growth is not None and stats['growth'] > max_growth:
+        errors.append("The deploy of %s grew by %s bytes, more than --max-growth (%s bytes)" %
+            (stats['deploy_directory'], stats['growth'], max_growth))
+    return errors
+
+def read_blobs(hashes):
+    """
+    Return the contents of the git blobs ``hashes``, using a single ``git
+    cat-file --batch`` process.
 
-    Assumes that :func:`setup_GitHub_push`, which sets up the ``doctr_remote``
-    remote, has been run.
+    Blobs that were not downloaded by a ``blob:none`` fetch (see
+    :func:`fetch_deploy_branch`) are fetched as they are needed.
+    """
+    if not hashes:
+        return []
+    out = subprocess.run(['git', 'cat-file', '--batch'],
+        input=''.join(i + '\n' for i in hashes).encode('utf-8'),
+        stdout=subprocess.PIPE, check=True).stdout
+    # Each blob is "<hash> blob <size>\n<contents>\n"
+    blobs = []
+    pos = 0
+    for _ in hashes:
+        header_end = out.index(b'\n', pos)
+        size = int(out[pos:header_end].split()[2])
+        blobs.append(out[header_end + 1:header_end + 1 + size])
+        pos = header_end + 1 + size + 1
+    return blobs
+
+def find_deploy_dirs(ref, log_file='.doctr-files'):
+    """
+    Find the deploy directories in the git ref ``ref`` (like
+    ``'doctr_remote/gh-pages'``), that is, the directories other than the
+    root that have a ``.doctr-files`` manifest.
 
-    Returns True if changes were committed and False if no changes were
-    committed.
+    Returns a dictionary mapping each directory to the metadata in its
+    manifest (see :func:`parse_manifest_metadata`).
+    """
+    manifests = {os.path.dirname(path): hash for path, (hash, _) in
+        get_tree_files(ref).items() if os.path.basename(path) == log_file and
+        os.path.dirname(path)}
+    dirs = sorted(manifests)
+    fetch_missing_blobs(ref, list(manifests.values()))
+    blobs = read_blobs([manifests[d] for d in dirs])
+    return {d: parse_manifest_metadata(blob.decode('utf-8')) for d, blob in
+        zip(dirs, blobs)}
+
+def plan_gc(deploy_dirs, *, keep_tags=None, existing_branches=None,
+    max_age=None, now=None):
+    """
+    Decide which of the deploy directories ``deploy_dirs`` (see
+    :func:`find_deploy_dirs`) ``doctr gc`` removes.
+
+    - If ``keep_tags`` is not None, only the directories of the
+      ``keep_tags`` most recently deployed tags are kept. A tag can have
+      several directories (like ``tag-v1.0`` and a ``stable`` alias), and
+      it counts as deployed when the most recent of them changed.
+    - If ``existing_branches`` is not None, branch directories whose branch
+      is not in it are removed.
+    - If ``max_age`` is not None, directories that have been unchanged for
+      more than ``max_age`` days are removed. Deploys that don't change any
+      file don't count (see :func:`get_deploy_metadata`).
+
+    A directory is removed if any of these match. Directories whose manifest
+    doesn't have the needed metadata (for instance, those deployed by an
+    older doctr) are kept.
+
+    Returns a dictionary mapping the directories to remove to the reason they
+    are removed.
+    """
+    if now is None:
+        now = time.time()
+    remove = {}
+    if keep_tags is not None:
+        changed = {}
+        for d, metadata in deploy_dirs.items():
+            if 'tag' in metadata:
+                changed[metadata['tag']] = max(changed.get(metadata['tag'], 0),
+                    int(metadata.get('changed', 0)))
+        kept = set(sorted(changed, key=lambda tag: (changed[tag], tag),
+            reverse=True)[:keep_tags])
+        for d, metadata in deploy_dirs.items():
+            if 'tag' in metadata and metadata['tag'] not in kept:
+                remove[d] = "tag %s is not one of the last %s tags deployed" % (metadata['tag'], keep_tags)
+    if existing_branches is not None:
+        for d, metadata in deploy_dirs.items():
+            if 'branch' in metadata and metadata['branch'] not in existing_branches:
+                remove[d] = "branch %s no longer exists" % metadata['branch']
+    if max_age is not None:
+        for d, metadata in deploy_dirs.items():
+            if 'changed' not in metadata:
+                continue
+            age = (now - int(metadata['changed']))/(24*60*60)
+            if age > max_age:
+                remove[d] = "unchanged for %d days" % age
+    return dict(sorted(remove.items()))
+
+def commit_gc(ref, deploy_dirs, remove, branch=DOCTR_WORKING_BRANCH):
+    """
+    Commit the removal of the deploy directories ``remove`` (a dictionary
+    from :func:`plan_gc`) on top of the git ref ``ref`` to ``branch``, in a
+    single commit. The current checkout is not touched.
+
+    ``deploy_dirs`` are all the deploy directories in ``ref`` (see
+    :func:`find_deploy_dirs`). Deploy directories nested in a removed
+    directory are kept, unless they are removed themselves.
+
+    Returns the number of files removed.
+    """
+    deploy_dirs = set(deploy_dirs)
+    changes = []
+    for path, (hash, _) in get_tree_files(ref).items():
+        # Find the deploy directory that owns the file
+        d = os.path.dirname(path)
+        while d and d not in deploy_dirs:
+            d = os.path.dirname(d)
+        if d in remove:
+            changes.append((path.encode('utf-8'), b'0', b'0'*len(hash)))
+
+    message = "Remove %s old deploy directories with doctr gc\n\n" % len(remove)
+    message += ''.join("%s: %s\n" % (d, reason) for d, reason in remove.items())
+    commit = commit_changes(sorted(changes),
+        subprocess.check_output(['git', 'rev-parse', ref]).decode('utf-8').strip(),
+        message.encode('utf-8'))
+    run(['git', 'update-ref', 'refs/heads/' + branch, commit])
+    return len(changes)
+
+def get_remote_branches(remote='origin'):
+    """
+    Return the set of the names of the branches in the git remote ``remote``.
+    """
+    out = subprocess.check_output(['git', 'ls-remote', '--heads', remote])
+    return {line.split('\t', 1)[1][len('refs/heads/'):] for line in
+        out.decode('utf-8').splitlines()}
+
+def get_commit_message():
+    """
+    Return the message used for the commits made by doctr.
     """
     TRAVIS_BUILD_NUMBER = os.environ.get("TRAVIS_BUILD_NUMBER", "<unknown>")
     TRAVIS_BRANCH = os.environ.get("TRAVIS_BRANCH", "<unknown>")
@@ -496,13 +1949,7 @@ def commit_docs(*, added, removed):
 
     DOCTR_COMMAND = ' '.join(map(shlex.quote, sys.argv))
 
-
-    if added:
-        run(['git', 'add', *added])
-    if removed:
-        run(['git', 'rm', *removed])
-
-    commit_message = """\
+    return """\
 Update docs after building Travis build {TRAVIS_BUILD_NUMBER} of
 {TRAVIS_REPO_SLUG}
 
@@ -525,39 +1972,581 @@ The doctr command that was run is
     DOCTR_COMMAND=DOCTR_COMMAND,
     )
 
-    # Only commit if there were changes
-    if run(['git', 'diff-index', '--exit-code', '--cached', '--quiet', 'HEAD', '--'], exit=False) != 0:
+def stage_paths(paths):
+    """
+    Stage the files ``paths`` in the git index. Files that exist are added
+    or updated, and files that don't exist are removed from the index.
+
+    The paths are streamed to a single ``git update-index --stdin`` process
+    instead of being passed on the command line, so that any number of paths
+    can be staged without running into the command line length limit or
+    printing all of them to the log.
+    """
+    if not paths:
+        return
+    run(['git', 'update-index', '--add', '--remove', '-z', '--stdin'],
+        input=b'\0'.join(os.fsencode(i) for i in paths) + b'\0',
+        summary='%s paths' % format(len(paths), ','))
+
+def commit_docs(*, added, removed, callback=None):
+    """
+    Commit the docs to the current branch
+
+    ``added`` and ``removed`` are staged with :func:`stage_paths`, and the
+    index is committed as is. Files changed by ``--command`` should be added
+    to the index.
+
+    Assumes that :func:`setup_GitHub_push`, which sets up the ``doctr_remote``
+    remote, has been run.
+
+    ``callback`` is called with ``'phase_started'`` and ``'phase_finished'``
+    events for the ``'stage'`` and ``'commit'`` phases (see
+    :func:`sync_from_log`).
+
+    Returns True if changes were committed and False if no changes were
+    committed.
+    """
+    callback = callback or _no_callback
+    callback('phase_started', {'phase': 'stage'})
+    stage_paths(added + removed)
+    callback('phase_finished', {'phase': 'stage'})
+
+    # Commit straight from the index. 'git commit -a' and 'git diff-index
+    # HEAD' would both stat every tracked file on the deploy branch, which
+    # dominates on branches with hundreds of thousands of files.
+    callback('phase_started', {'phase': 'commit'})
+    try:
+        tree = subprocess.check_output(['git', 'write-tree']).decode('utf-8').strip()
+        head_tree = subprocess.check_output(['git', 'rev-parse',
+            'HEAD^{tree}']).decode('utf-8').strip()
+        # Only commit if there were changes
+        if tree == head_tree:
+            return False
+
         print("Committing")
-        run(['git', 'commit', '-am', commit_message])
+        commit = subprocess.run(['git', 'commit-tree', tree, '-p', 'HEAD'],
+            input=get_commit_message().encode('utf-8'), stdout=subprocess.PIPE,
+            check=True).stdout.decode('utf-8').strip()
+        run(['git', 'update-ref', '-m', 'doctr: commit docs', 'HEAD', commit])
         return True
+    finally:
+        callback('phase_finished', {'phase': 'commit'})
 
-    return False
+def git_hash_objects(paths, callback=None):
+    """
+    Write the files ``paths`` to the git object database and return the list
+    of their blob hashes, using a single ``git hash-object -w --stdin-paths``
+    process.
 
-def push_docs(deploy_branch='gh-pages', retries=5):
+    The files are written as they are, like :func:`git_blob_hash`. The
+    ``.gitattributes`` of the build repository are not applied to them.
+
+    ``callback`` is called with a ``'file_hashed'`` event for every file as
+    its hash is read back (see :func:`sync_from_log`).
+    """
+    callback = callback or _no_callback
+    p = subprocess.Popen(['git', 'hash-object', '-w', '--no-filters', '--stdin-paths'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    def write_paths():
+        try:
+            for path in paths:
+                p.stdin.write(path.encode('utf-8') + b'\n')
+        finally:
+            p.stdin.close()
+
+    # Write from another thread so that a full stdout pipe can't deadlock
+    writer = threading.Thread(target=write_paths)
+    writer.start()
+    hashes = []
+    bytes_so_far = 0
+    for path in paths:
+        hashes.append(p.stdout.readline().decode('utf-8').strip())
+        size = os.stat(path).st_size
+        bytes_so_far += size
+        callback('file_hashed', {'path': path, 'bytes': size,
+                                 'bytes_so_far': bytes_so_far})
+    writer.join()
+    if p.wait() or len(hashes) != len(paths) or not all(hashes):
+        raise RuntimeError("git hash-object failed")
+    return hashes
+
+def git_hash_object(data):
+    """
+    Write ``data`` (bytes) to the git object database as a blob and return
+    its hash.
+    """
+    return subprocess.run(['git', 'hash-object', '-w', '--no-filters',
+        '--stdin'], input=data,
+        stdout=subprocess.PIPE, check=True).stdout.decode('utf-8').strip()
+
+def commit_docs_plumbing(src, deploy_dir, deploy_branch, exclude=(), *,
+    parent=None, gitattributes=False, branch=DOCTR_WORKING_BRANCH, metadata=(),
+    callback=None):
+    """
+    Commit the built docs in ``src`` to ``deploy_dir`` on top of the remote
+    deploy branch without checking it out, using git plumbing commands.
+
+    The tree of ``parent`` (by default ``doctr_remote/<deploy_branch>``) is
+    read into a temporary index (``GIT_INDEX_FILE``), the built docs are
+    hashed into the object database with :func:`git_hash_objects`, the
+    index is updated with ``git update-index --index-info``, and the commit is
+    created with ``git write-tree`` and ``git commit-tree``. Files listed in
+    the ``.doctr-files`` manifest that are no longer in ``src`` are removed,
+    and a new version 2 manifest is written. If the deploy branch doesn't
+    exist yet, a ``.nojekyll`` file is added. If ``gitattributes`` is True, the
+    ``.gitattributes`` file at the root of the branch is updated with the
+    already compressed file types in the docs (see
+    :func:`update_gitattributes`). Neither the working tree nor the
+    index of the current checkout is touched, so disk writes scale with the
+    built docs rather than with the size of the deploy branch.
+
+    The commit is stored in the local branch ``branch`` (by default
+    ``DOCTR_WORKING_BRANCH``), so that it can be pushed with
+    :func:`push_docs`.
+
+    ``exclude`` and ``metadata`` are the same as for :func:`sync_from_log`
+    and ``callback`` gets the ``'hash'`` and ``'commit'`` phases and a ``'file_hashed'`` event
+    for each file.
+
+    Returns True if a commit was made and False if the docs did not change.
+    """
+    from os.path import join, normpath
+
+    callback = callback or _no_callback
+    if parent is None:
+        parent = 'doctr_remote/' + deploy_branch
+    if subprocess.run(['git', 'rev-parse', '--verify', '--quiet', parent + '^{commit}'],
+                      stdout=subprocess.DEVNULL).returncode:
+        parent = None
+
+    excluded = compile_exclude(exclude)
+    log_file = join(deploy_dir, '.doctr-files')
+    src_root = src if os.path.isdir(src) else os.path.dirname(src)
+    new_files = [f for f in walk_built_docs(src, exclude) if not f.endswith(os.sep)]
+    src_paths = [join(src_root, f) for f in new_files]
+
+    callback('phase_started', {'phase': 'hash'})
+    print("Hashing %s files" % format(len(src_paths), ','))
+    hashes = git_hash_objects(src_paths, callback=callback)
+    callback('phase_finished', {'phase': 'hash'})
+
+    callback('phase_started', {'phase': 'commit'})
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = dict(os.environ, GIT_INDEX_FILE=join(tmp_dir, 'index'))
+            if parent:
+                subprocess.run(['git', 'read-tree', parent], env=env, check=True)
+            else:
+                subprocess.run(['git', 'read-tree', '--empty'], env=env, check=True)
+
+            index_info = []
+            logged = []
+            new_paths = set()
+            for f, path, hash in zip(new_files, src_paths, hashes):
+                st = os.stat(path)
+                mode = '100755' if st.st_mode & 0o100 else '100644'
+                repo_path = normpath(join(deploy_dir, f))
+                new_paths.add(repo_path)
+                index_info.append('%s %s\t%s' % (mode, hash, repo_path))
+                logged.append((join(deploy_dir, f), st.st_size, hash))
+
+            if parent:
+                tree = get_tree_files(parent, deploy_dir)
+                version, old_entries = get_ref_manifest(parent, log_file)
+                for path, size, hash in old_entries:
+                    if (path in new_paths or path not in tree or
+                        excluded(os.path.relpath(path, deploy_dir))):
+                        continue
+                    index_info.append('0 %s\t%s' % ('0'*40, path))
+            else:
+                print("Adding .nojekyll file to new {} branch".format(deploy_branch))
+                index_info.append('100644 %s\t.nojekyll' % git_hash_object(b''))
+
+            if gitattributes:
+                text = ''
+                if parent:
+                    text = subprocess.run(['git', 'show', parent + ':.gitattributes'],
+                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+                    ).stdout.decode('utf-8')
+                new_text = update_gitattributes(text, get_binary_patterns(new_files))
+                if new_text != text:
+                    index_info.append('100644 %s\t.gitattributes' %
+                        git_hash_object(new_text.encode('utf-8')))
+
+            # Keep the old manifest (and its metadata) if nothing changed
+            if not parent or version != 2 or sorted((normpath(path), size, hash)
+                for path, size, hash in logged) != old_entries:
+                manifest = format_manifest(logged, version=2,
+                    metadata=metadata).encode('utf-8')
+                index_info.append('100644 %s\t%s' % (git_hash_object(manifest),
+                    normpath(log_file)))
+
+            print("Updating the index with %s entries" % format(len(index_info), ','))
+            subprocess.run(['git', 'update-index', '-z', '--index-info'],
+                input='\0'.join(index_info).encode('utf-8') + b'\0', env=env,
+                check=True)
+            new_tree = subprocess.check_output(['git', 'write-tree'],
+                env=env).decode('utf-8').strip()
+
+        if parent and new_tree == subprocess.check_output(['git', 'rev-parse',
+            parent + '^{tree}']).decode('utf-8').strip():
+            return False
+
+        print("Committing")
+        parent_args = ['-p', parent] if parent else []
+        commit = subprocess.run(['git', 'commit-tree', new_tree, *parent_args],
+            input=get_commit_message().encode('utf-8'), stdout=subprocess.PIPE,
+            check=True).stdout.decode('utf-8').strip()
+        run(['git', 'update-ref', 'refs/heads/' + branch, commit])
+        return True
+    finally:
+        callback('phase_finished', {'phase': 'commit'})
+
+def _raw_diff(*args):
+    """
+    Return ``{path: (mode, hash)}`` for the paths that differ in ``git
+    diff-tree -r args``, with the mode and hash on the new side (mode
+    ``b'0'`` for removed paths).
+    """
+    out = subprocess.check_output(['git', 'diff-tree', '-r', '-z',
+        '--no-renames', '--no-commit-id', *args])
+    # The raw format is ":<old mode> <new mode> <old hash> <new hash>
+    # <status>\0<path>\0" for each path
+    changes = {}
+    fields = iter(out.split(b'\0'))
+    for meta in fields:
+        if not meta:
+            continue
+        path = next(fields)
+        _, new_mode, old_hash, new_hash, status = meta.split()
+        if status == b'D':
+            changes[path] = (b'0', b'0'*len(old_hash))
+        else:
+            changes[path] = (new_mode, new_hash)
+    return changes
+
+def get_commit_changes(commit, onto):
+    """
+    Return the changes to make to ``onto`` so that the paths changed by
+    ``commit`` (compared to its parent, or all its paths if it has no parent)
+    are as they are in ``commit``, as a sorted list of ``(path, mode, hash)``
+    (bytes, with mode ``b'0'`` for paths to remove).
+
+    Paths that are already the same in ``onto`` are not included, nor are
+    paths that ``commit`` didn't change.
+
+    If ``onto`` is None (the branch doesn't exist anymore), all the paths of
+    ``commit`` are included.
+    """
+    if onto is None:
+        empty_tree = subprocess.run(['git', 'mktree'], input=b'',
+            stdout=subprocess.PIPE, check=True).stdout.decode('utf-8').strip()
+        changes = _raw_diff(empty_tree, commit)
+        return sorted((path, mode, hash) for path, (mode, hash) in changes.items())
+    parents = subprocess.check_output(['git', 'rev-list', '--parents', '-n',
+        '1', commit]).decode('utf-8').split()[1:]
+    changes = _raw_diff(parents[0], commit) if parents else _raw_diff('--root', commit)
+    if onto != (parents[0] if parents else None):
+        remaining = _raw_diff(onto, commit)
+        changes = {path: changes[path] for path in remaining if path in changes}
+    return sorted((path, mode, hash) for path, (mode, hash) in changes.items())
+
+def commit_changes(changes, onto, message):
+    """
+    Create a commit with parent ``onto`` (or no parent if ``onto`` is None)
+    and the tree of ``onto`` with ``changes`` (see :func:`get_commit_changes`)
+    applied, in a temporary index.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp_dir, 'index'))
+        subprocess.run(['git', 'read-tree', onto or '--empty'], env=env, check=True)
+        subprocess.run(['git', 'update-index', '-z', '--index-info'],
+            input=b''.join(mode + b' ' + hash + b'\t' + path + b'\0'
+                for path, mode, hash in changes), env=env, check=True)
+        new_tree = subprocess.check_output(['git', 'write-tree'],
+            env=env).decode('utf-8').strip()
+
+    parent_args = ['-p', onto] if onto else []
+    return subprocess.run(['git', 'commit-tree', new_tree, *parent_args],
+        input=message, stdout=subprocess.PIPE,
+        check=True).stdout.decode('utf-8').strip()
+
+def replay_commit(commit, onto):
+    """
+    Create a commit on top of ``onto`` that makes the same changes as
+    ``commit`` made to its parent (or that adds all of its files if it has
+    no parent), with the same message.
+
+    Only the paths changed by ``commit`` are touched: they are set to their
+    contents in ``commit`` (or removed), and everything else is kept as it is
+    in ``onto``. This is done in a temporary index, so the current checkout
+    is not touched.
+
+    Returns the new commit, or None if ``onto`` already has these changes.
+    """
+    changes = get_commit_changes(commit, onto)
+    if not changes:
+        return None
+    message = subprocess.check_output(['git', 'show', '-s', '--format=format:%B', commit])
+    return commit_changes(changes, onto, message)
+
+def split_commit(commit, onto, max_size):
+    """
+    Like :func:`replay_commit`, but split the changes into a chain of commits
+    on top of ``onto`` where each commit adds at most ``max_size`` bytes of
+    file contents (a single larger file gets a commit of its own). The paths
+    are kept in order, so that a directory tends to end up in one commit.
+
+    Returns the list of commits, which is empty if ``onto`` already has all
+    the changes. The last commit has the same tree as :func:`replay_commit`
+    would give.
+    """
+    changes = get_commit_changes(commit, onto)
+    blobs = [hash.decode('utf-8') for path, mode, hash in changes
+        if mode in (b'100644', b'100755', b'120000')]
+    blob_sizes = dict(zip(blobs, get_blob_sizes(blobs)))
+
+    chunks = []
+    chunk_size = 0
+    for path, mode, hash in changes:
+        size = blob_sizes.get(hash.decode('utf-8'), 0)
+        if not chunks or chunk_size + size > max_size and chunks[-1]:
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append((path, mode, hash))
+        chunk_size += size
+
+    message = subprocess.check_output(['git', 'show', '-s', '--format=format:%B', commit])
+    commits = []
+    for n, chunk in enumerate(chunks, 1):
+        if len(chunks) > 1:
+            chunk_message = message.rstrip() + b'\n\nPart %d of %d\n' % (n, len(chunks))
+        else:
+            chunk_message = message
+        onto = commit_changes(chunk, onto, chunk_message)
+        commits.append(onto)
+    return commits
+
+# Used for the pushes, since the deploy branch is mostly files that are
+# already compressed or that are never changed: objects bigger than this are
+# not delta compressed.
+PUSH_GIT_CONFIG = [
+    ('core.bigFileThreshold', '16m'),
+]
+
+def get_push_config(commit):
+    """
+    Return the ``git -c`` arguments for pushing ``commit``.
+
+    This includes :data:`PUSH_GIT_CONFIG`, and the ``.gitattributes`` of
+    ``commit`` as ``core.attributesFile``, so that the ``-delta`` attributes
+    from :func:`update_gitattributes` apply when the pack is generated, even
+    when the commit isn't checked out.
+    """
+    args = []
+    for key, value in PUSH_GIT_CONFIG:
+        args += ['-c', '%s=%s' % (key, value)]
+    p = subprocess.run(['git', 'show', commit + ':.gitattributes'],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if p.returncode == 0:
+        path = os.path.abspath(subprocess.check_output(['git', 'rev-parse',
+            '--git-path', 'doctr-attributes']).decode('utf-8').strip())
+        with open(path, 'wb') as f:
+            f.write(p.stdout)
+        args += ['-c', 'core.attributesFile=' + path]
+    return args
+
+def recommit(commit, parent):
+    """
+    Create a copy of ``commit`` (same tree, message, author and committer)
+    with ``parent`` as its only parent, or with no parent if ``parent`` is
+    None, and return it.
+    """
+    fields = subprocess.check_output(['git', 'show', '-s', '--date=raw',
+        '--format=format:%T%x00%an%x00%ae%x00%ad%x00%cn%x00%ce%x00%cd%x00%B', commit]
+        ).split(b'\0', 7)
+    tree = fields[0].decode('utf-8')
+    env = dict(os.environ)
+    for var, value in zip(['GIT_AUTHOR_NAME', 'GIT_AUTHOR_EMAIL',
+        'GIT_AUTHOR_DATE', 'GIT_COMMITTER_NAME', 'GIT_COMMITTER_EMAIL',
+        'GIT_COMMITTER_DATE'], fields[1:7]):
+        env[var] = value.decode('utf-8')
+    parent_args = ['-p', parent] if parent else []
+    return subprocess.run(['git', 'commit-tree', tree, *parent_args],
+        input=fields[7], env=env, stdout=subprocess.PIPE,
+        check=True).stdout.decode('utf-8').strip()
+
+def truncate_history(commit, keep):
+    """
+    Return a copy of ``commit`` whose history only has the last ``keep``
+    commits of the first parent history of ``commit`` (including itself),
+    the oldest of them becoming a root commit. With ``keep=1``, this is a
+    single commit with no parents.
+
+    The commits are copied with :func:`recommit`, so truncating a history
+    that is already short enough gives back the same commit. If the
+    repository is shallow, the history stops at the shallow boundary.
+    """
+    chain = subprocess.check_output(['git', 'rev-list', '--first-parent',
+        '-n', str(keep), commit]).decode('utf-8').split()
+    new = None
+    for c in reversed(chain):
+        new = recommit(c, new)
+    return new
+
+def fetch_archive_ref(archive_ref):
+    """
+    Fetch the ref ``archive_ref`` (like ``refs/doctr/gh-pages-archive``) from
+    ``doctr_remote`` (only its last commit) and return its commit, or None if
+    it doesn't exist.
+    """
+    p = subprocess.run(['git', 'ls-remote', 'doctr_remote', archive_ref],
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if p.returncode:
+        sys.exit(red("Could not list the refs of doctr_remote: %s" % p.returncode))
+    if not p.stdout.strip():
+        print(archive_ref, "doesn't exist on doctr_remote")
+        return None
+    local_ref = 'refs/remotes/doctr_remote/doctr-archive'
+    run(['git', 'fetch', '--no-tags', '--depth=1', 'doctr_remote',
+        '+{}:{}'.format(archive_ref, local_ref)])
+    return subprocess.check_output(['git', 'rev-parse',
+        local_ref]).decode('utf-8').strip()
+
+def push_docs(deploy_branch='gh-pages', retries=5, *, backoff=1, max_backoff=30,
+    max_push_size=None, branches=None, keep_history=None, archive_ref=None):
     """
     Push the changes to the branch named ``deploy_branch``.
 
     Assumes that :func:`setup_GitHub_push` has been run and returned True, and
-    that :func:`commit_docs` has been run. Does not push anything if no changes
-    were made.
-
-    """
-
-    code = 1
-    while code and retries:
-        print("Pulling")
-        code = run(['git', 'pull', '-s', 'recursive', '-X', 'ours',
-            'doctr_remote', deploy_branch], exit=False)
-        print("Pushing commit")
-        code = run(['git', 'push', '-q', 'doctr_remote',
-            '{}:{}'.format(DOCTR_WORKING_BRANCH, deploy_branch)], exit=False)
-        if code:
-            retries -= 1
-            print("Push failed, retrying")
-            time.sleep(1)
+    that :func:`commit_docs` (or :func:`commit_docs_plumbing`) has been run.
+    Does not push anything if no changes were made.
+
+    The commit on ``DOCTR_WORKING_BRANCH`` is pushed as it is first. If the
+    push is rejected because the remote branch moved, the new remote branch is
+    fetched and the changes of the commit are replayed on top of it with
+    :func:`replay_commit`, as a single new commit, and that is pushed. Since
+    the new commit is a child of the fetched remote branch, the push only
+    succeeds if the remote branch didn't move again (a compare-and-swap), so
+    the history stays linear and the changes that other builds made to
+    other paths are kept. ``DOCTR_WORKING_BRANCH`` itself is not changed.
+
+    To push several branches at once, pass ``branches``, a dict of ``{branch:
+    local branch with the commit}`` (the default is ``{deploy_branch:
+    DOCTR_WORKING_BRANCH}``). They are pushed with a single ``git push
+    --atomic``, so either all of them are updated or none is, and retries
+    replay the commits of all of them.
+
+    If ``max_push_size`` (in bytes) is given, the changes are split with
+    :func:`split_commit` and the commits are pushed one at a time. After a
+    failed push, the changes that already made it to the remote branch are
+    left out when splitting the remaining ones, so the upload resumes where
+    it stopped. This can't be used with more than one branch.
+
+    If ``keep_history`` is given, the history of the branch is cut to the last
+    ``keep_history`` commits with :func:`truncate_history` (1 keeps a single
+    commit with no parents), and it is pushed with ``--force-with-lease``, so
+    that the push is still rejected if another build pushed in the meantime.
+    If ``archive_ref`` is also given, a copy of the commit that the remote
+    branch pointed to is added on top of ``archive_ref`` in the same atomic
+    push, so that the archive has a linear history of every state of the
+    branch. This can't be used with more than one branch or with
+    ``max_push_size``.
+
+    Between attempts, it waits for a random time between 0 and ``backoff *
+    2**n`` seconds (at most ``max_backoff``) for the n-th retry, so that
+    builds that collide don't retry in lockstep.
+
+    Returns a list with the time each push took, like ``[{'attempt': 1,
+    'seconds': 1.2, 'pushed': False}, ...]``.
+    """
+    if branches is None:
+        branches = {deploy_branch: DOCTR_WORKING_BRANCH}
+    if max_push_size and len(branches) > 1:
+        raise ValueError("max_push_size can't be used with more than one branch")
+    if keep_history and (max_push_size or len(branches) > 1):
+        raise ValueError("keep_history can't be used with max_push_size or more than one branch")
+    commits = {branch: subprocess.check_output(['git', 'rev-parse',
+        ref]).decode('utf-8').strip() for branch, ref in branches.items()}
+    # The commits of the remote branches that the commits to push are based on
+    onto = {}
+    for branch, commit in commits.items():
+        parents = subprocess.check_output(['git', 'rev-list', '--parents',
+            '-n', '1', commit]).decode('utf-8').split()[1:]
+        onto[branch] = parents[0] if parents else None
+
+    # Each item of to_push is a {branch: commit} dict to push at once
+    if max_push_size:
+        [(branch, commit)] = commits.items()
+        to_push = [{branch: c} for c in split_commit(commit, onto[branch],
+            max_push_size)]
+    else:
+        to_push = [commits]
+    attempts = []
+    failures = 0
+    while True:
+        for n, push in enumerate(to_push, 1):
+            start = time.monotonic()
+            if len(to_push) > 1:
+                print("Pushing commit %d of %d" % (n, len(to_push)))
+            else:
+                print("Pushing commit")
+            if keep_history:
+                [(branch, c)] = push.items()
+                push = {branch: truncate_history(c, keep_history)}
+            refspecs = ['{}:refs/heads/{}'.format(c, branch) for branch, c
+                in sorted(push.items())]
+            leases = []
+            if keep_history:
+                leases.append('--force-with-lease=refs/heads/{}:{}'.format(
+                    branch, onto[branch] or ''))
+                if archive_ref and onto[branch]:
+                    archive = fetch_archive_ref(archive_ref)
+                    refspecs.append('{}:{}'.format(recommit(onto[branch],
+                        archive), archive_ref))
+                    leases.append('--force-with-lease={}:{}'.format(
+                        archive_ref, archive or ''))
+            atomic = ['--atomic'] if len(refspecs) > 1 else []
+            code = run(['git', *get_push_config(refspecs[0].split(':')[0]),
+                'push', '-q', *atomic, *leases, 'doctr_remote', *refspecs],
+                exit=False)
+            attempts.append({'attempt': len(attempts) + 1,
+                'seconds': time.monotonic() - start, 'pushed': not code})
+            print("Push attempt %d %s after %.1f seconds" % (len(attempts),
+                'failed' if code else 'succeeded', attempts[-1]['seconds']))
+            if code:
+                break
+        else:
+            return attempts
+
+        failures += 1
+        if failures > retries:
+            sys.exit("Giving up...")
+
+        delay = random.uniform(0, min(max_backoff, backoff * 2**(failures - 1)))
+        print("Retrying in %.1f seconds" % delay)
+        time.sleep(delay)
+
+        start = time.monotonic()
+        existing = fetch_deploy_branches(list(commits))
+        onto = {branch: None for branch in commits}
+        for branch in existing:
+            onto[branch] = subprocess.check_output(['git', 'rev-parse',
+                'doctr_remote/' + branch]).decode('utf-8').strip()
+        if max_push_size:
+            [(branch, commit)] = commits.items()
+            to_push = [{branch: c} for c in split_commit(commit, onto[branch],
+                max_push_size)]
         else:
-            return
-    sys.exit("Giving up...")
+            replayed = {branch: replay_commit(commit, onto[branch])
+                for branch, commit in commits.items()}
+            replayed = {branch: c for branch, c in replayed.items() if c}
+            to_push = [replayed] if replayed else []
+        attempts[-1]['seconds'] += time.monotonic() - start
+        if not to_push:
+            print("The remote branch already has these changes")
+            return attempts
 
 def last_commit_by_doctr():
     """Check whether the author of `HEAD` is `doctr` to avoid starting an